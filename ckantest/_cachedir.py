@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import errno
+import os
+
+
+def cache_dir(*parts):
+    '''
+    Returns a path in the per-user ckantest cache directory: the CKANTEST_CACHE_DIR
+    environment variable or ckantest in the user's cache directory (XDG_CACHE_HOME or
+    ~/.cache).
+    :param parts: subdirectories to join onto it
+    :return: str
+    '''
+    root = os.environ.get(u'CKANTEST_CACHE_DIR') or os.path.join(
+        os.environ.get(u'XDG_CACHE_HOME') or os.path.join(os.path.expanduser(u'~'), u'.cache'),
+        u'ckantest')
+    return os.path.join(root, *parts)
+
+
+def make_dir(path):
+    '''
+    Creates a cache directory (and any missing parents) that only the current user can
+    access, if it doesn't exist already.
+    :param path: the directory
+    '''
+    if os.path.isdir(path):
+        return
+    parent = os.path.dirname(path)
+    if parent and parent != path:
+        # makedirs only applies the mode to the last directory (from python 3.7)
+        make_dir(parent)
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        # another process (e.g. an xdist worker) may have created it first
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def owned(path):
+    '''
+    Checks that a cached file belongs to the current user, so that files planted by anyone
+    else aren't used.
+    :param path: the file
+    :return: True if the current user owns it (or the platform doesn't have user ids)
+    '''
+    return not hasattr(os, u'getuid') or os.stat(path).st_uid == os.getuid()
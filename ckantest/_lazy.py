@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import importlib
+import sys
+import types
+
+# module-level __getattr__ (PEP 562) is only supported from 3.7
+supported = sys.version_info >= (3, 7)
+
+
+class _LazyModule(types.ModuleType):
+    '''
+    Stands in for a module in sys.modules on Python versions without module __getattr__, so
+    that attribute lookups that miss the module's dict go to its __getattr__ function.
+    '''
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails; the original functions are kept out of the
+        # module's dict so they don't shadow these methods
+        if name.startswith(u'__'):
+            raise AttributeError(name)
+        return self._ckantest_getattr(name)
+
+    def __dir__(self):
+        if self._ckantest_dir is not None:
+            return self._ckantest_dir()
+        return sorted(self.__dict__)
+
+
+def module_getattr(module_name, namespace, getattr_, dir_=None):
+    '''
+    Gives a module a __getattr__ (and optionally __dir__) function. On Python 3.7+ these are
+    just set in the module's namespace; on older versions the module in sys.modules is replaced
+    with a ModuleType subclass that calls them. Values the functions cache should be stored in
+    module_dict(module_name) rather than globals(), as the two differ on older versions.
+
+    :param module_name: the module's name (__name__)
+    :param namespace: the module's globals()
+    :param getattr_: function taking an attribute name and returning its value (or raising
+                     AttributeError)
+    :param dir_: function returning the module's attribute names
+    '''
+    if supported:
+        namespace[u'__getattr__'] = getattr_
+        if dir_ is not None:
+            namespace[u'__dir__'] = dir_
+        return
+
+    module = _LazyModule(module_name)
+    module.__dict__.update(namespace)
+    # python 2 clears a module's globals when the module object is deallocated, so the
+    # original has to stay alive for the functions defined in it to keep working
+    module._ckantest_original = sys.modules[module_name]
+    module._ckantest_getattr = getattr_
+    module._ckantest_dir = dir_
+    sys.modules[module_name] = module
+
+
+def module_dict(module_name):
+    '''
+    Returns the dict attributes of the named module are looked up in.
+
+    :param module_name: the module's name (__name__)
+    :return: dict
+    '''
+    return sys.modules[module_name].__dict__
+
+
+def lazy(package, namespace, submodules=None, attributes=None):
+    '''
+    Makes a package's submodules and re-exported attributes load on first access instead of
+    when the package is imported.
+
+        lazy(__name__, globals(), submodules=['mocking'], attributes={'Configurer': '.config'})
+
+    :param package: the package name (__name__)
+    :param namespace: the package's globals()
+    :param submodules: names of submodules to import on access
+    :param attributes: dict of attribute name -> relative module to import it from
+    '''
+    submodules = list(submodules or [])
+    attributes = dict(attributes or {})
+
+    def _load(name):
+        if name in submodules:
+            value = importlib.import_module(u'.' + name, package)
+        elif name in attributes:
+            value = getattr(importlib.import_module(attributes[name], package), name)
+        else:
+            raise AttributeError(u'module {0} has no attribute {1}'.format(package, name))
+        module_dict(package)[name] = value
+        return value
+
+    def _dir():
+        return sorted(set(module_dict(package)) | set(submodules) | set(attributes))
+
+    namespace[u'__all__'] = submodules + list(attributes)
+    module_getattr(package, namespace, _load, _dir)
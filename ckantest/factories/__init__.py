@@ -4,4 +4,13 @@
 # This file is part of ckantest
 # Created by the Natural History Museum in London, UK
 
-from .data import DataFactory, DataConstants
+from ckantest._lazy import lazy
+
+lazy(__name__, globals(), attributes={
+    u'DataFactory': u'.data',
+    u'DataConstants': u'.constants',
+    u'Field': u'.records',
+    u'GeneratedFile': u'.files',
+    u'RecordGenerator': u'.records',
+    u'load_scenario': u'.scenario'
+    })
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import functools
+import hashlib
+import inspect
+import logging
+import os
+
+from ckantest._cachedir import cache_dir as cache_dir_path, make_dir, owned
+from ckantest.helpers.database import Snapshot
+
+import ckan
+from ckan.lib import search
+from ckan.plugins import toolkit
+
+logger = logging.getLogger(u'ckantest')
+
+
+class FixtureCache(object):
+    '''
+    Stores the database and DataFactory state produced by a creation recipe on disk so that
+    later runs can restore it in one bulk load instead of calling the action API again. Each
+    entry is keyed by the recipe's source code and the CKAN and plugin versions, so changing
+    any of them invalidates it. Datastore contents are not included.
+
+    Only the recipe's own source is hashed, so changes to any functions it calls won't
+    invalidate its entries; pass a version (and change it when they change) to cover them.
+
+    Entries are pickles, so loading one can run arbitrary code: the default directory is only
+    accessible to the current user, and entries owned by anyone else are ignored.
+    '''
+
+    def __init__(self, cache_dir=None, version=None):
+        '''
+        :param cache_dir: the directory to store cached fixtures in; defaults to the
+                          CKANTEST_CACHE_DIR environment variable or ckantest in the user's
+                          cache directory (XDG_CACHE_HOME or ~/.cache)
+        :param version: any value to include in the key, e.g. to invalidate entries when
+                        the helpers a recipe uses change
+        '''
+        self.cache_dir = cache_dir or cache_dir_path()
+        self.version = version
+
+    @staticmethod
+    def versions():
+        '''
+        The CKAN version and the versions of the distributions providing the loaded plugins.
+        :return: list of (name, version) tuples
+        '''
+        from pkg_resources import iter_entry_points
+
+        versions = [(u'ckan', ckan.__version__)]
+        for name in sorted(set(toolkit.config.get(u'ckan.plugins', u'').split())):
+            entry_point = next(iter_entry_points(u'ckan.plugins', name), None)
+            dist = getattr(entry_point, u'dist', None)
+            versions.append((name, dist.version if dist else None))
+        return versions
+
+    def key(self, recipe):
+        '''
+        Hashes the recipe, the cache version and the CKAN and plugin versions.
+        :param recipe: a callable that takes a DataFactory and creates fixtures with it
+        :return: str
+        '''
+        digest = hashlib.sha1(self._source(recipe).encode(u'utf-8'))
+        digest.update(repr((self.version, self.versions())).encode(u'utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def _source(cls, recipe):
+        '''
+        Returns the source code of the recipe (or of the function and arguments of a
+        functools.partial), falling back to its qualified name if the source isn't available.
+        '''
+        if isinstance(recipe, functools.partial):
+            return u'{0}{1!r}{2!r}'.format(cls._source(recipe.func), recipe.args,
+                                           sorted(recipe.keywords.items()))
+        try:
+            return inspect.getsource(recipe)
+        except (IOError, OSError, TypeError):
+            name = getattr(recipe, u'__qualname__', None) or getattr(recipe, u'__name__', None)
+            if name is None:
+                # the repr of an instance usually includes its address, so use the class
+                name = type(recipe).__name__
+            return u'{0}.{1}'.format(getattr(recipe, u'__module__', u''), name)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + u'.pickle')
+
+    def restore(self, data_factory, recipe):
+        '''
+        Loads the cached state for the recipe into the database and the data factory.
+        :return: True if it was cached, False if not
+        '''
+        path = self.path(self.key(recipe))
+        if not os.path.exists(path):
+            return False
+        if not owned(path):
+            logger.warning(u'Ignoring cached fixtures in {0}: not owned by the current '
+                           u'user.'.format(path))
+            return False
+        logger.debug(u'Restoring cached fixtures from {0}...'.format(path))
+        snapshot = Snapshot.load(path)
+        state = snapshot.restore()
+        data_factory.load_state(state)
+        package_ids = [p[u'id'] for p in data_factory.packages.to_dict().values()]
+        if package_ids:
+            search.rebuild(package_ids=package_ids, defer_commit=True, quiet=True)
+            search.commit()
+        return True
+
+    def save(self, data_factory, recipe):
+        '''
+        Writes the current database contents and the data factory's state to the cache.
+        '''
+        make_dir(self.cache_dir)
+        path = self.path(self.key(recipe))
+        snapshot = Snapshot()
+        snapshot.take(**data_factory.dump_state())
+        # write to a temp file first so an interrupted run can't leave a broken entry
+        snapshot.save(path + u'.tmp')
+        os.rename(path + u'.tmp', path)
+        logger.debug(u'Cached fixtures in {0}.'.format(path))
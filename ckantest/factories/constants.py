@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+
+class DataConstants(object):
+    title_long = u'This is a very long package title that is going to be approximately ' \
+                 u'two hundred characters long by the time it is finished. It is being ' \
+                 u'used to test extensions for CKAN as part of the ckantest package.'
+    title_short = u'A test package'
+
+    authors_long = u'Waylon Dalton; Justine Henderson; ' \
+                   u'Abdullah Lang; Marcus Cruz; Thalia Cobb; ' \
+                   u'Mathias Little; Eddie Randolph; ' \
+                   u'Angela Walker; Lia Shelton; Hadassah Hartman; ' \
+                   u'Joanna Shaffer; Jonathon Sheppard'
+    authors_long_first = u'Dalton'
+    authors_short = u'Test Author'
+    authors_short_first = u'Author'
+
+    records = [{
+        u'common_name': u'Egyptian vulture',
+        u'scientific_name': u'Neophron percnopterus'
+        }, {
+        u'common_name': u'Malabar squirrel',
+        u'scientific_name': u'Ratufa indica'
+        }, {
+        u'common_name': u'Screamer, crested',
+        u'scientific_name': u'Chauna torquata'
+        }, {
+        u'common_name': u'Heron, giant',
+        u'scientific_name': u'Ardea golieth'
+        }, {
+        u'common_name': u'Water monitor',
+        u'scientific_name': u'Varanus salvator'
+        }]
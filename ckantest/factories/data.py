@@ -5,49 +5,70 @@
 # Created by the Natural History Museum in London, UK
 
 import logging
+from contextlib import contextmanager
+from itertools import islice
 
-from ckantest.helpers import mocking
+from ckantest.helpers import database, mocking
 from ckantest.helpers.containers import Packages
+from .cache import FixtureCache
+from .constants import DataConstants
 
+from ckan import model, plugins
+from ckan.lib import search
 from ckan.plugins import toolkit
-from ckan.tests import factories, helpers
+from ckan.tests import factories
 
 logger = logging.getLogger(u'ckantest')
 
+_missing = object()
+
+
+def _chunks(records, size):
+    '''
+    Yields lists of up to size records from any iterable without consuming more than one
+    chunk at a time.
+    '''
+    iterator = iter(records)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
 
 class DataFactory(object):
     '''
     A helper class for creating and manipulating standard test datasets.
     '''
+    chunk_size = 10000  # default number of records per datastore write
 
-    def __init__(self):
+    def __init__(self, snapshot=False, fresh_packages=False):
+        '''
+        :param snapshot: if True, take a snapshot of the database once the base fixtures
+                         (sysadmin, default org) have been created and restore that in
+                         destroy() instead of rebuilding the whole database
+        :param fresh_packages: if True, self.packages calls package_show on every access
+                               instead of caching the package dicts
+        '''
+        self.use_snapshot = snapshot
+        self.fresh_packages = fresh_packages
         # defining attribute names
         self._sysadmin = None
         self._org = None
         self.users = None
         self.orgs = None
         self.packages = None
+        self._counters = {}
+        self._deferred = None
         # this actually sets them properly (so they can be reset as needed)
         self.refresh()
 
     def package(self, name=None, context=None, activate=True, **kwargs):
         if name is None:
-            previous = [int(n.split(u'_')[-1]) for n in self.packages.keys() if
-                        n.startswith(u'test_package_')]
-            i = max(previous) + 1 if len(previous) > 0 else 1
-            name = u'test_package_' + str(i).zfill(3)
+            name = self._next_name(u'test_package_', self.packages)
         if name in self.packages:
             raise KeyError(u'Duplicated key: ' + name)
-        data_dict = {
-            u'title': DataConstants.title_short,
-            u'name': name,
-            u'notes': u'these are some notes',
-            u'dataset_category': u'cat1',
-            u'private': False,
-            u'owner_org': self.org[u'id'],
-            u'author': DataConstants.authors_short
-            }
-        data_dict.update(kwargs)
+        data_dict = self._package_dict(name, **kwargs)
         if context is None:
             logger.debug(u'Creating dataset "{0}" as sysadmin...'.format(name))
             package = factories.Dataset(**data_dict)
@@ -55,43 +76,265 @@ class DataFactory(object):
             logger.debug(u'Creating dataset "{0}" as user {1}...'.format(name, context[u'user']))
             package = toolkit.get_action(u'package_create')(context, data_dict)
         self.packages[name] = package
+        self._changed(package[u'id'])
         if activate:
             self.activate_package(package[u'id'], context=context)
         return package
 
-    def resource(self, package_id, context=None, records=None, activate=True, **kwargs):
+    def packages_bulk(self, n, context=None, batch_size=100, **kwargs):
+        '''
+        Creates a large number of packages using the same defaults as package(). The
+        packages are created in the 'active' state (so there's no show/update round trip
+        afterwards), and each batch is committed in one go and then indexed with a single
+        search rebuild rather than one package at a time.
+        :param n: the number of packages to create
+        :param context: the context to create them in; must be allowed to set the state, so
+                        defaults to the sysadmin context
+        :param batch_size: the number of packages to create per commit
+        :param kwargs: values for every package's data_dict, overriding the defaults
+        :return: list of the created package dicts
+        '''
+        return self.create_packages([kwargs] * n, context=context, batch_size=batch_size)
+
+    def create_packages(self, packages, context=None, batch_size=100):
+        '''
+        Creates packages from a list of data_dict overrides in batches, as packages_bulk()
+        does, except that each package can have different values.
+        :param packages: a list of dicts of values for each package (a name is generated if
+                         one isn't given)
+        :param context: the context to create them in; defaults to the sysadmin context
+        :param batch_size: the number of packages to create per commit
+        :return: list of the created package dicts
+        '''
+        use_context = context or self.context
+        logger.debug(u'Creating {0} datasets as user {1}...'.format(len(packages),
+                                                                    use_context[u'user']))
+        created = []
+        for start in range(0, len(packages), batch_size):
+            # indexes the batch when it's been committed (or, if indexing is already deferred,
+            # leaves it to the outer block)
+            with self.deferred_indexing(batch_size):
+                for values in packages[start:start + batch_size]:
+                    values = dict(values)
+                    name = values.pop(u'name', None) or self._next_name(u'test_package_',
+                                                                        self.packages)
+                    if name in self.packages:
+                        raise KeyError(u'Duplicated key: ' + name)
+                    values.setdefault(u'state', u'active')
+                    data_dict = self._package_dict(name, **values)
+                    package_context = dict(use_context, defer_commit=True)
+                    package = toolkit.get_action(u'package_create')(package_context,
+                                                                    data_dict)
+                    self.packages[name] = package
+                    self._changed(package[u'id'])
+                    created.append(package)
+                model.repo.commit()
+        return created
+
+    def create_users(self, users, context=None, batch_size=100):
+        '''
+        Creates users from a list of data_dict overrides in batches, committing once per
+        batch. They get the same defaults as ckan's user factory (an email address based on
+        the name and a password).
+        :param users: a list of dicts of values for each user (a name is generated if one
+                      isn't given)
+        :param context: the context to create them in; defaults to the sysadmin context
+        :param batch_size: the number of users to create per commit
+        :return: list of the created user dicts
+        '''
+        use_context = context or self.context
+        logger.debug(u'Creating {0} users as user {1}...'.format(len(users),
+                                                                 use_context[u'user']))
+        created = []
+        for start in range(0, len(users), batch_size):
+            for values in users[start:start + batch_size]:
+                values = dict(values)
+                name = values.pop(u'name', None) or self._next_name(u'test_user_', self.users)
+                if name in self.users:
+                    raise KeyError(u'Duplicated key: ' + name)
+                data_dict = {
+                    u'name': name,
+                    u'email': u'{0}@ckan.org'.format(name),
+                    u'password': u'RandomPassword123'
+                    }
+                data_dict.update(values)
+                user_context = dict(use_context, defer_commit=True)
+                user = toolkit.get_action(u'user_create')(user_context, data_dict)
+                self.users[name] = user
+                created.append(user)
+            model.repo.commit()
+        return created
+
+    def create_organisations(self, organisations, context=None):
+        '''
+        Creates organisations from a list of data_dict overrides. CKAN commits each one when it
+        makes the creating user an admin, so only organization_create's own commit is
+        deferred; add other members with create_memberships() rather than one at a time.
+        :param organisations: a list of dicts of values for each organisation (a name is
+                              generated if one isn't given)
+        :param context: the context to create them in; defaults to the sysadmin context
+        :return: list of the created organisation dicts
+        '''
+        use_context = context or self.context
+        logger.debug(u'Creating {0} organisations as user {1}...'.format(len(organisations),
+                                                                         use_context[u'user']))
+        created = []
+        for values in organisations:
+            values = dict(values)
+            name = values.pop(u'name', None) or self._next_name(u'test_org_', self.orgs)
+            if name in self.orgs:
+                raise KeyError(u'Duplicated key: ' + name)
+            data_dict = {
+                u'name': name
+                }
+            data_dict.update(values)
+            org_context = dict(use_context, defer_commit=True)
+            org = toolkit.get_action(u'organization_create')(org_context, data_dict)
+            self.orgs[name] = org
+            created.append(org)
+        return created
+
+    def create_memberships(self, memberships, batch_size=100):
+        '''
+        Adds users to organisations in batches. member_create commits every membership, so
+        the member rows are added directly (updating the capacity of existing ones, as
+        member_create does) and committed once per batch.
+        :param memberships: a list of dicts with the 'organisation' and 'user' (names or ids)
+                            and optionally the 'capacity' (defaults to 'member')
+        :param batch_size: the number of memberships to add per commit
+        '''
+        logger.debug(u'Adding {0} organisation members...'.format(len(memberships)))
+        for start in range(0, len(memberships), batch_size):
+            for membership in memberships[start:start + batch_size]:
+                group = model.Group.get(membership[u'organisation'])
+                if group is None:
+                    raise toolkit.ObjectNotFound(
+                        u'Organisation {0} was not found.'.format(membership[u'organisation']))
+                user = model.User.get(membership[u'user'])
+                if user is None:
+                    raise toolkit.ObjectNotFound(
+                        u'User {0} was not found.'.format(membership[u'user']))
+                member = model.Session.query(model.Member).filter(
+                    model.Member.table_name == u'user',
+                    model.Member.table_id == user.id,
+                    model.Member.group_id == group.id,
+                    model.Member.state == u'active').first()
+                if member is None:
+                    member = model.Member(table_name=u'user', table_id=user.id,
+                                          group_id=group.id, state=u'active')
+                    member.group = group
+                member.capacity = membership.get(u'capacity', u'member')
+                model.Session.add(member)
+            model.repo.commit()
+
+    def resource(self, package_id, context=None, records=None, activate=True, chunk_size=None,
+                 job_queue=None, upload=None, **kwargs):
+        '''
+        Creates a resource and, if activate is True, adds it to the datastore.
+        :param package_id: the package to add the resource to
+        :param context: the context to create the resource in; defaults to the sysadmin
+        :param records: a list, iterator or generator of records to add to the datastore;
+                        defaults to the upload's records if there is one
+        :param activate: activate the package and add the resource to the datastore
+        :param chunk_size: the number of records to write per datastore call (defaults to
+                           DataFactory.chunk_size)
+        :param job_queue: a mocking.JobQueue to run any background jobs on; if None, jobs
+                          are run synchronously
+        :param upload: a files.GeneratedFile to upload as the resource's file instead of using
+                       a URL
+        :param kwargs: values for the resource data_dict, overriding the defaults
+        '''
         data_dict = {
             u'package_id': package_id,
             u'url': u'http://placekitten.com/200/300'
             }
-        data_dict.update(kwargs)
-        if context is None:
-            logger.debug(u'Creating resource as sysadmin...')
-            resource = factories.Resource(**data_dict)
+        if upload is None:
+            data_dict.update(kwargs)
+            resource = self._create_resource(data_dict, context)
         else:
-            logger.debug(u'Creating resource as user {0}...'.format(context[u'user']))
-            resource = toolkit.get_action(u'resource_create')(context, data_dict)
-
+            data_dict.update({
+                u'url': upload.name,
+                u'url_type': u'upload',
+                u'format': upload.file_format.upper()
+                })
+            data_dict.update(kwargs)
+            with upload.upload() as file_storage:
+                data_dict[u'upload'] = file_storage
+                resource = self._create_resource(data_dict, context)
+            if records is None:
+                records = upload.records()
+        self._changed(package_id)
         if activate:
             self.activate_package(package_id, context=context)
-            data_dict = {
-                u'resource_id': resource[u'id'],
-                u'force': True
-                }
-            if records:
-                data_dict[u'records'] = records
-            use_context = context or self.context
-            logger.debug(u'Adding resource to datastore as user {0}...'.format(use_context[u'user']))
-            toolkit.get_action(u'datastore_create')(use_context, data_dict)
-            data_dict[u'replace'] = True
-            with mocking.Patches.sync_queue():
-                toolkit.get_action(u'datastore_upsert')(use_context, data_dict)
+            self.load_records(resource[u'id'], records, context=context, chunk_size=chunk_size,
+                              job_queue=job_queue)
+            self._changed(package_id)
         return resource
 
+    def _create_resource(self, data_dict, context=None):
+        if context is None:
+            logger.debug(u'Creating resource as sysadmin...')
+            return factories.Resource(**data_dict)
+        logger.debug(u'Creating resource as user {0}...'.format(context[u'user']))
+        return toolkit.get_action(u'resource_create')(context, data_dict)
+
+    def load_records(self, resource_id, records=None, context=None, chunk_size=None,
+                     job_queue=None):
+        '''
+        Adds a resource to the datastore, writing the records in fixed-size chunks so that
+        only one chunk is held in memory at a time. Each record is only written once.
+        :param resource_id: the resource to add
+        :param records: a list, iterator or generator of records
+        :param context: the context to write in; defaults to the sysadmin
+        :param chunk_size: the number of records per datastore call (defaults to
+                           DataFactory.chunk_size)
+        :param job_queue: a mocking.JobQueue to run any background jobs on (waiting for the
+                          ones this thread started to finish before returning); if None, jobs
+                          are run synchronously
+        '''
+        use_context = context or self.context
+        chunks = _chunks(records or [], chunk_size or self.chunk_size)
+        versioned = plugins.plugin_loaded(u'versioned_datastore')
+        data_dict = {
+            u'resource_id': resource_id,
+            u'force': True
+            }
+        # the core datastore creates the table from the first chunk of records; the versioned
+        # datastore only takes records through upserts
+        first = None if versioned else next(chunks, None)
+        if first:
+            data_dict[u'records'] = first
+        logger.debug(u'Adding resource to datastore as user {0}...'.format(use_context[u'user']))
+        toolkit.get_action(u'datastore_create')(use_context, data_dict)
+        patch = mocking.Patches.sync_queue() if job_queue is None else job_queue.patch()
+        with patch:
+            upserted = False
+            for chunk in chunks:
+                upsert_dict = {
+                    u'resource_id': resource_id,
+                    u'force': True,
+                    u'records': chunk
+                    }
+                if versioned:
+                    # the first chunk replaces anything already there; the rest add to it
+                    upsert_dict[u'replace'] = not upserted
+                else:
+                    upsert_dict[u'method'] = u'insert'
+                toolkit.get_action(u'datastore_upsert')(use_context, upsert_dict)
+                upserted = True
+            if versioned and not upserted:
+                toolkit.get_action(u'datastore_upsert')(use_context, {
+                    u'resource_id': resource_id,
+                    u'force': True,
+                    u'replace': True
+                    })
+        if job_queue is not None:
+            # other threads may be sharing the queue, so don't wait for their jobs too
+            job_queue.wait(own=True)
+
     def organisation(self, name=None, **kwargs):
         if name is None:
-            name = u'test_org_' + str(
-                max([int(n.split(u'_')[-1]) for n in self.orgs.keys()]) + 1).zfill(3)
+            name = self._next_name(u'test_org_', self.orgs)
         if name in self.orgs:
             raise KeyError(u'Duplicated key: ' + name)
         data_dict = {
@@ -105,8 +348,7 @@ class DataFactory(object):
 
     def user(self, name=None, **kwargs):
         if name is None:
-            name = u'test_user_' + str(
-                max([int(n.split(u'_')[-1]) for n in self.users.keys()]) + 1).zfill(3)
+            name = self._next_name(u'test_user_', self.users)
         if name in self.users:
             raise KeyError(u'Duplicated key: ' + name)
         data_dict = {
@@ -131,6 +373,7 @@ class DataFactory(object):
         logger.debug(u'Deactivating package {0} as user {1}...'.format(pkg_dict[u'name'],
                                                                        use_context[u'user']))
         toolkit.get_action(u'package_update')(use_context, pkg_dict)
+        self._changed(package_id)
 
     def activate_package(self, package_id, context=None):
         '''
@@ -145,6 +388,7 @@ class DataFactory(object):
         logger.debug(u'Activating package {0} as user {1}...'.format(pkg_dict[u'name'],
                                                                      use_context[u'user']))
         toolkit.get_action(u'package_update')(use_context, pkg_dict)
+        self._changed(package_id)
 
     def remove_resources(self, package_name, context=None):
         '''
@@ -154,41 +398,160 @@ class DataFactory(object):
             toolkit.get_action(u'resource_delete')(context or self.context, {
                 u'id': r[u'id']
                 })
+        package_id = self.packages[package_name][u'id']
+        self._changed(package_id)
         self.packages[package_name] = toolkit.get_action(u'package_show')(context or self.context, {
-            u'id': self.packages[package_name][u'id']
+            u'id': package_id
             })
 
     def deactivate_resources(self, package_name):
         '''
-        Does not make any actual database changes - makes a copy of the
-        current specified package dictionary and mocks deactivating all
-        its resources by setting their states to 'draft'. Returns this mock
-        dictionary.
-        :return: dict
+        Does not make any actual database changes - returns a copy of the
+        current specified package dictionary with all its resources' states
+        set to 'draft'. The copy is an immutable snapshot that shares
+        everything except the package and resource dicts with the stored
+        package, so the stored package isn't affected (use
+        helpers.frozen.thaw() if a mutable dict is needed).
+        :return: FrozenDict
+        '''
+        pkg_dict = self.packages.snapshot(package_name)
+        return pkg_dict.set(u'resources',
+                            pkg_dict[u'resources'].map(lambda r: r.set(u'state', u'draft')))
+
+    @contextmanager
+    def deferred_indexing(self, batch_size=100):
+        '''
+        A context manager that turns off automatic search indexing while it's active, then
+        reindexes only the packages this factory changed, in batches, when it exits:
+
+            with df.deferred_indexing():
+                df.packages_bulk(1000)
+
+        :param batch_size: the number of packages to reindex per search commit
+        '''
+        if self._deferred is not None:
+            # already deferring; the outer block will do the indexing
+            yield
+            return
+        self._deferred = set()
+        original = toolkit.config.get(u'ckan.search.automatic_indexing', _missing)
+        toolkit.config[u'ckan.search.automatic_indexing'] = False
+        try:
+            yield
+        finally:
+            if original is _missing:
+                toolkit.config.pop(u'ckan.search.automatic_indexing', None)
+            else:
+                toolkit.config[u'ckan.search.automatic_indexing'] = original
+            changed = sorted(self._deferred)
+            self._deferred = None
+            logger.debug(u'Reindexing {0} packages...'.format(len(changed)))
+            for start in range(0, len(changed), batch_size):
+                search.rebuild(package_ids=changed[start:start + batch_size], defer_commit=True,
+                               quiet=True)
+                search.commit()
+            self.packages.mark_indexed()
+
+    def _changed(self, package_id):
+        '''
+        Records that a package has been changed: removes it from the package cache and, if
+        indexing is deferred, adds it to the packages to reindex.
+        :param package_id: the package id or name
         '''
-        pkg_dict = self.packages[package_name].copy()
-        resources_dict = pkg_dict[u'resources']
-        for r in resources_dict:
-            r[u'state'] = u'draft'
-        pkg_dict[u'resources'] = resources_dict
-        return pkg_dict
+        self.packages.invalidate(package_id)
+        if self._deferred is not None:
+            self._deferred.add(package_id)
+            self.packages.mark_unindexed(package_id)
+
+    def _package_dict(self, name, **kwargs):
+        '''
+        The default data_dict for a new package.
+        '''
+        data_dict = {
+            u'title': DataConstants.title_short,
+            u'name': name,
+            u'notes': u'these are some notes',
+            u'dataset_category': u'cat1',
+            u'private': False,
+            u'owner_org': self.org[u'id'],
+            u'author': DataConstants.authors_short
+            }
+        data_dict.update(kwargs)
+        return data_dict
+
+    def _next_name(self, prefix, existing):
+        '''
+        Returns the next unused name with the given prefix, e.g. test_package_004. Uses a
+        counter per prefix rather than scanning the existing keys.
+        :param prefix: the name prefix
+        :param existing: the map of names already in use
+        '''
+        i = self._counters.get(prefix, 0)
+        name = None
+        while name is None or name in existing:
+            i += 1
+            name = prefix + str(i).zfill(3)
+        self._counters[prefix] = i
+        return name
+
+    def cached(self, recipe, cache=None):
+        '''
+        Creates fixtures by calling recipe(self), or restores them from the on-disk cache if
+        the same recipe has been run before with the same CKAN and plugin versions.
+        :param recipe: a callable that takes this DataFactory and creates fixtures with it
+        :param cache: a FixtureCache; defaults to one in the default cache directory (pass
+                      one with a version if the recipe calls helpers that might change)
+        '''
+        cache = cache or FixtureCache()
+        if not cache.restore(self, recipe):
+            recipe(self)
+            cache.save(self, recipe)
+
+    def dump_state(self):
+        '''
+        Returns the factory's maps and fixtures as a dict that can be pickled.
+        '''
+        return {
+            u'sysadmin': self.sysadmin,
+            u'org': self.org,
+            u'users': dict(self.users),
+            u'orgs': dict(self.orgs),
+            u'packages': self.packages.to_dict(),
+            u'counters': dict(self._counters)
+            }
+
+    def load_state(self, state):
+        '''
+        Replaces the factory's maps and fixtures with ones from dump_state().
+        '''
+        self._sysadmin = state.get(u'sysadmin')
+        self._org = state.get(u'org')
+        self.users = dict(state.get(u'users', {}))
+        self.orgs = dict(state.get(u'orgs', {}))
+        self.packages = Packages(fresh=self.fresh_packages)
+        for name, pkg_dict in state.get(u'packages', {}).items():
+            self.packages[name] = pkg_dict
+        self._counters = dict(state.get(u'counters', {}))
 
     def create(self):
         '''
         Runs any necessary creation functions.
         '''
+        if self.use_snapshot and not database.snapshot.taken:
+            database.snapshot.take(sysadmin=self.sysadmin, org=self.org)
 
     def destroy(self):
         '''
         Resets the database and any class variables that have been altered,
         e.g. title string.
         '''
-        helpers.reset_db()
-        self._sysadmin = None
-        self._org = None
+        fixtures = database.reset(self.use_snapshot)
+        self._sysadmin = fixtures.get(u'sysadmin')
+        self._org = fixtures.get(u'org')
         self.users = {}
         self.orgs = {}
-        self.packages = Packages()
+        self.packages = Packages(fresh=self.fresh_packages)
+        self._counters = {}
 
     def refresh(self):
         '''
@@ -223,36 +586,3 @@ class DataFactory(object):
         if self._org is None:
             self._org = factories.Organization()
         return self._org
-
-
-class DataConstants(object):
-    title_long = u'This is a very long package title that is going to be approximately ' \
-                 u'two hundred characters long by the time it is finished. It is being ' \
-                 u'used to test extensions for CKAN as part of the ckantest package.'
-    title_short = u'A test package'
-
-    authors_long = u'Waylon Dalton; Justine Henderson; ' \
-                   u'Abdullah Lang; Marcus Cruz; Thalia Cobb; ' \
-                   u'Mathias Little; Eddie Randolph; ' \
-                   u'Angela Walker; Lia Shelton; Hadassah Hartman; ' \
-                   u'Joanna Shaffer; Jonathon Sheppard'
-    authors_long_first = u'Dalton'
-    authors_short = u'Test Author'
-    authors_short_first = u'Author'
-
-    records = [{
-        u'common_name': u'Egyptian vulture',
-        u'scientific_name': u'Neophron percnopterus'
-        }, {
-        u'common_name': u'Malabar squirrel',
-        u'scientific_name': u'Ratufa indica'
-        }, {
-        u'common_name': u'Screamer, crested',
-        u'scientific_name': u'Chauna torquata'
-        }, {
-        u'common_name': u'Heron, giant',
-        u'scientific_name': u'Ardea golieth'
-        }, {
-        u'common_name': u'Water monitor',
-        u'scientific_name': u'Varanus salvator'
-        }]
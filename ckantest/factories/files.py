@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import csv
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+from ckantest._cachedir import cache_dir as cache_dir_path, make_dir, owned
+from .records import RecordGenerator
+
+logger = logging.getLogger(u'ckantest')
+
+
+class GeneratedFile(object):
+    '''
+    A data file (CSV, TSV or JSON) built from a RecordGenerator, for testing uploads,
+    downloads and datastore loads with realistically large files:
+
+        upload = GeneratedFile(rows=5000000)
+        df.resource(package_id, upload=upload)
+
+    The file isn't written until it's first needed, and then it's streamed to disk a batch of
+    records at a time. Files are cached on disk by their spec (format, rows, seed and fields),
+    so identical specs are only generated once and are shared between tests and test runs.
+    Uploads are read through a memory map, so the file is never loaded into memory.
+    '''
+    formats = {
+        u'csv': u'text/csv',
+        u'tsv': u'text/tab-separated-values',
+        u'json': u'application/json'
+        }
+
+    def __init__(self, generator=None, rows=1000, file_format=u'csv', name=None, cache_dir=None):
+        '''
+        :param generator: the RecordGenerator to build the file from; defaults to one with the
+                          default fields
+        :param rows: the number of records in the file
+        :param file_format: one of GeneratedFile.formats
+        :param name: the filename to give the upload; defaults to one based on the spec
+        :param cache_dir: the directory to store generated files in; defaults to files in
+                          the CKANTEST_CACHE_DIR environment variable or ckantest in the
+                          user's cache directory (XDG_CACHE_HOME or ~/.cache)
+        '''
+        if file_format not in self.formats:
+            raise ValueError(u'Unknown file format: ' + file_format)
+        self.generator = generator or RecordGenerator()
+        self.rows = rows
+        self.file_format = file_format
+        self.name = name or u'generated_{0}.{1}'.format(self.key[:12], file_format)
+        self.cache_dir = cache_dir or cache_dir_path(u'files')
+
+    @property
+    def content_type(self):
+        return self.formats[self.file_format]
+
+    @property
+    def key(self):
+        '''
+        Hashes everything that affects the file's contents.
+        :return: str
+        '''
+        fields = [sorted(vars(f).items()) for f in self.generator.fields]
+        spec = [self.file_format, self.rows, self.generator.seed, self.generator.batch_size,
+                fields]
+        return hashlib.sha1(repr(spec).encode(u'utf-8')).hexdigest()
+
+    @property
+    def path(self):
+        '''
+        The path to the file, generating it first if it doesn't exist.
+        :return: str
+        '''
+        path = os.path.join(self.cache_dir, self.key + u'.' + self.file_format)
+        if not os.path.exists(path):
+            self._write(path)
+        elif not owned(path):
+            logger.warning(u'Replacing generated file {0}: not owned by the current '
+                           u'user.'.format(path))
+            self._write(path)
+        return path
+
+    @property
+    def size(self):
+        '''
+        The size of the file in bytes, generating it first if it doesn't exist.
+        :return: int
+        '''
+        return os.path.getsize(self.path)
+
+    def records(self):
+        '''
+        Generates the records in the file, without reading it; suitable for
+        DataFactory.resource(records=...).
+        '''
+        return self.generator.records(self.rows)
+
+    def _write(self, path):
+        '''
+        Streams the records to a temporary file, then moves it into place so that other
+        processes (e.g. xdist workers) never see a partly written file.
+        '''
+        make_dir(self.cache_dir)
+        logger.debug(u'Generating {0} rows of {1}...'.format(self.rows, self.file_format))
+        handle, partial = tempfile.mkstemp(dir=self.cache_dir, suffix=u'.partial')
+        try:
+            delimiter = u'\t' if self.file_format == u'tsv' else u','
+            if self.file_format == u'json':
+                with io.open(handle, u'w', encoding=u'utf-8') as f:
+                    self._write_json(f)
+            elif sys.version_info[0] < 3:
+                # python 2's csv module only writes encoded byte strings
+                with io.open(handle, u'wb') as f:
+                    self._write_delimited(f, str(delimiter), encoding=u'utf-8')
+            else:
+                with io.open(handle, u'w', encoding=u'utf-8', newline=u'') as f:
+                    self._write_delimited(f, delimiter)
+            os.rename(partial, path)
+        except Exception:
+            os.remove(partial)
+            raise
+
+    def _write_delimited(self, f, delimiter, encoding=None):
+        names = [field.name for field in self.generator.fields]
+
+        def cell(value):
+            if value is None:
+                return u''
+            if encoding is not None and isinstance(value, type(u'')):
+                return value.encode(encoding)
+            return value
+
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow([cell(n) for n in names])
+        for batch in self.generator.batches(self.rows):
+            writer.writerows([[cell(r[n]) for n in names] for r in batch])
+
+    def _write_json(self, f):
+        f.write(u'[')
+        separator = u'\n'
+        for batch in self.generator.batches(self.rows):
+            for record in batch:
+                f.write(separator + json.dumps(record))
+                separator = u',\n'
+        f.write(u'\n]\n')
+
+    @contextmanager
+    def open(self):
+        '''
+        Opens the file as a read-only memory map, generating it first if it doesn't exist.
+        '''
+        with io.open(self.path, u'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield mapped
+            finally:
+                mapped.close()
+
+    @contextmanager
+    def upload(self):
+        '''
+        Opens the file as an upload that can be passed as the 'upload' field of a resource
+        dict. It's streamed from the memory map by CKAN's uploader, so it must be used before
+        this exits. Note that CKAN rejects uploads larger than ckan.max_resource_size (in MB)
+        and needs ckan.storage_path to be set.
+        :return: werkzeug FileStorage
+        '''
+        from werkzeug.datastructures import FileStorage
+
+        with self.open() as mapped:
+            yield FileStorage(stream=mapped, filename=self.name, content_type=self.content_type)
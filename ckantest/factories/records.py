@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import zlib
+from datetime import date, timedelta
+from random import Random
+
+from .constants import DataConstants
+
+
+class Field(object):
+    '''
+    Describes how to generate the values for one field of a record.
+    '''
+    types = [u'text', u'int', u'float', u'bool', u'date', u'choice', u'words']
+
+    def __init__(self, name, field_type=u'text', cardinality=None, null_rate=0.0, values=None,
+                 length=10, separator=u' ', low=0, high=1000000):
+        '''
+        :param name: the field name
+        :param field_type: one of Field.types; 'choice' picks one of the values, 'words' joins
+                           length values together with the separator (for long text)
+        :param cardinality: the number of distinct values to generate; if None, every value
+                            is generated independently (and text values are unique)
+        :param null_rate: the proportion of values that should be None (0-1)
+        :param values: the values to pick from for 'choice' and 'words' fields
+        :param length: the number of values to join together for 'words' fields
+        :param separator: the string to join 'words' values with
+        :param low: the minimum value for numeric fields (and days after 2000-01-01 for dates)
+        :param high: the maximum value for numeric fields (and dates)
+        '''
+        if field_type not in self.types:
+            raise ValueError(u'Unknown field type: ' + field_type)
+        if field_type in [u'choice', u'words'] and not values:
+            raise ValueError(u'{0} fields need a list of values'.format(field_type))
+        self.name = name
+        self.field_type = field_type
+        self.cardinality = cardinality
+        self.null_rate = null_rate
+        self.values = list(values or [])
+        self.length = length
+        self.separator = separator
+        self.low = low
+        self.high = high
+
+    def pool(self, rng):
+        '''
+        Generates the distinct values for a field with a set cardinality.
+        :param rng: a Random instance
+        :return: list, or None if the cardinality isn't set
+        '''
+        if self.cardinality is None:
+            return None
+        return self._generate(rng, 0, self.cardinality)
+
+    def column(self, rng, start, size, pool=None):
+        '''
+        Generates the values for this field for a batch of records.
+        :param rng: the field's Random instance
+        :param start: the index of the first record in the batch
+        :param size: the number of values to generate
+        :param pool: the distinct values to pick from, if the cardinality is set
+        :return: list
+        '''
+        if pool is not None:
+            n = len(pool)
+            column = [pool[int(rng.random() * n)] for _ in range(size)]
+        else:
+            column = self._generate(rng, start, size)
+        if self.null_rate:
+            column = [None if rng.random() < self.null_rate else v for v in column]
+        return column
+
+    def _generate(self, rng, start, size):
+        r = rng.random
+        if self.field_type == u'text':
+            return [u'{0}_{1}'.format(self.name, i) for i in range(start, start + size)]
+        if self.field_type == u'int':
+            span = self.high - self.low + 1
+            return [self.low + int(r() * span) for _ in range(size)]
+        if self.field_type == u'float':
+            span = self.high - self.low
+            return [self.low + r() * span for _ in range(size)]
+        if self.field_type == u'bool':
+            return [r() < 0.5 for _ in range(size)]
+        if self.field_type == u'date':
+            epoch = date(2000, 1, 1)
+            span = self.high - self.low + 1
+            return [(epoch + timedelta(days=self.low + int(r() * span))).isoformat() for _ in
+                    range(size)]
+        n = len(self.values)
+        if self.field_type == u'choice':
+            return [self.values[int(r() * n)] for _ in range(size)]
+        # picking every word for every value is slow for long text, so pick a random stream
+        # of words once per batch and take each value from a random offset within it
+        stream = [self.values[int(r() * n)] for _ in range(self.length + 4096)]
+        sep = self.separator
+        length = self.length
+        offsets = [int(r() * 4096) for _ in range(size)]
+        return [sep.join(stream[o:o + length]) for o in offsets]
+
+
+class _FieldRandom(Random):
+    '''
+    A Random seeded from the generator seed and the field name, so a field's values don't
+    change when other fields are added or removed.
+    '''
+
+    def __new__(cls, seed, name):
+        # python 2's Random.__new__ only accepts a seed
+        return super(_FieldRandom, cls).__new__(cls)
+
+    def __init__(self, seed, name):
+        # masked so the seeds are the same on python 2, where crc32 is signed
+        self.pool_seed = zlib.crc32(u'{0}:{1}:pool'.format(seed, name).encode(u'utf-8')) & \
+            0xffffffff
+        super(_FieldRandom, self).__init__(
+            zlib.crc32(u'{0}:{1}'.format(seed, name).encode(u'utf-8')) & 0xffffffff)
+
+
+default_fields = [
+    Field(u'common_name', u'choice', values=[r[u'common_name'] for r in DataConstants.records]),
+    Field(u'scientific_name', u'choice',
+          values=[r[u'scientific_name'] for r in DataConstants.records]),
+    Field(u'title_long', u'words', values=DataConstants.title_long.split(u' '), length=30),
+    Field(u'authors_long', u'words', values=DataConstants.authors_long.split(u'; '), length=12,
+          separator=u'; '),
+    Field(u'count', u'int', low=0, high=1000, null_rate=0.1),
+    Field(u'recorded', u'date', low=0, high=7000, cardinality=365)
+    ]
+
+
+class RecordGenerator(object):
+    '''
+    Lazily generates any number of records from a list of fields. Values are generated a
+    column at a time in batches, and the output is deterministic for a given seed, field list
+    and batch size.
+    '''
+
+    def __init__(self, fields=None, seed=0, batch_size=10000):
+        '''
+        :param fields: a list of Field objects; defaults to fields based on DataConstants
+        :param seed: the random seed
+        :param batch_size: the number of records to generate at a time
+        '''
+        self.fields = fields or default_fields
+        self.seed = seed
+        self.batch_size = batch_size
+
+    def batches(self, n=None):
+        '''
+        Generates lists of up to batch_size records.
+        :param n: the total number of records; if None, generates indefinitely
+        '''
+        rngs = [_FieldRandom(self.seed, f.name) for f in self.fields]
+        pools = [f.pool(Random(rng.pool_seed)) for f, rng in zip(self.fields, rngs)]
+        names = [f.name for f in self.fields]
+        start = 0
+        while n is None or start < n:
+            size = self.batch_size if n is None else min(self.batch_size, n - start)
+            columns = [f.column(rng, start, size, pool) for f, rng, pool in
+                       zip(self.fields, rngs, pools)]
+            yield [dict(zip(names, row)) for row in zip(*columns)]
+            start += size
+
+    def records(self, n=None):
+        '''
+        Generates records one at a time; suitable for DataFactory.resource(records=...).
+        :param n: the total number of records; if None, generates indefinitely
+        '''
+        for batch in self.batches(n):
+            for record in batch:
+                yield record
+
+    def __iter__(self):
+        return self.records()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+
+from ckantest.helpers import mocking
+from .data import DataFactory
+
+import flask
+from ckan import model
+
+logger = logging.getLogger(u'ckantest')
+
+
+def read_scenario(source):
+    '''
+    Reads a scenario description.
+    :param source: a dict, or the path to a .json, .yml or .yaml file
+    :return: dict
+    '''
+    if isinstance(source, dict):
+        return source
+    with open(source, u'r') as f:
+        if source.endswith(u'.json'):
+            return json.load(f)
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(u'PyYAML is needed to read YAML scenarios.')
+        return yaml.safe_load(f)
+
+
+def load_scenario(source, data_factory=None, workers=1, batch_size=100):
+    '''
+    Creates the organisations, users, memberships, packages and resources described in a
+    scenario. Each level is created after the levels it depends on, in batches; resources
+    on different packages are created concurrently if workers > 1 (only use this with a
+    database that supports concurrent writes, i.e. not sqlite), in which case each thread
+    gets its own request context for the current flask app and any background jobs they
+    start run on a shared mocking.JobQueue.
+
+    The scenario looks like this (every key is optional):
+
+        organisations: [{name: org1, ...}]
+        users: [{name: user1, ...}]
+        memberships: [{organisation: org1, user: user1, capacity: editor}]
+        packages: [{name: pkg1, organisation: org1, resources: [{name: res1, ...}], ...}]
+        resources: [{package: pkg1, records: [...], ...}]
+
+    Packages without an organisation go in the factory's default org, and packages without a
+    name get a generated one. Extra keys are passed to the relevant DataFactory method.
+
+    :param source: a dict, or the path to a JSON or YAML file
+    :param data_factory: the DataFactory to create everything with; a new one if not given
+    :param workers: the number of threads to create resources with
+    :param batch_size: the number of users, memberships and packages to create per commit
+    :return: the DataFactory, with its maps filled in
+    '''
+    scenario = read_scenario(source)
+    df = data_factory or DataFactory()
+
+    df.create_users(scenario.get(u'users', []), batch_size=batch_size)
+    df.create_organisations(scenario.get(u'organisations', []))
+    df.create_memberships([{
+        u'organisation': df.orgs[membership[u'organisation']][u'id'],
+        u'user': df.users[membership[u'user']][u'id'],
+        u'capacity': membership.get(u'capacity', u'member')
+        } for membership in scenario.get(u'memberships', [])], batch_size=batch_size)
+
+    # resources are grouped by package so that each package is only changed by one thread
+    resources = {}
+    packages = []
+    for pkg in scenario.get(u'packages', []):
+        pkg = dict(pkg)
+        if not pkg.get(u'name'):
+            # named now so nested resources can be grouped by it
+            pkg[u'name'] = df._next_name(u'test_package_', df.packages)
+        org = pkg.pop(u'organisation', None)
+        if org is not None:
+            pkg[u'owner_org'] = df.orgs[org][u'id']
+        nested = pkg.pop(u'resources', [])
+        packages.append(pkg)
+        if nested:
+            resources[pkg[u'name']] = list(nested)
+    for res in scenario.get(u'resources', []):
+        res = dict(res)
+        resources.setdefault(res.pop(u'package'), []).append(res)
+    df.create_packages(packages, batch_size=batch_size)
+
+    def _create_resources(item, job_queue=None, flask_app=None):
+        if flask_app is not None:
+            # request contexts are per thread, so each worker needs its own
+            with flask_app.test_request_context():
+                return _create_resources(item, job_queue)
+        package_name, package_resources = item
+        try:
+            package_id = df.packages.to_dict()[package_name][u'id']
+            created = []
+            for r in package_resources:
+                r = dict(r)
+                r.setdefault(u'job_queue', job_queue)
+                created.append(df.resource(package_id, **r))
+            return created
+        finally:
+            # each thread has its own scoped session
+            model.Session.remove()
+
+    logger.debug(u'Creating resources on {0} packages with {1} workers...'.format(
+        len(resources), workers))
+    if workers > 1:
+        # mock.patch isn't thread safe, so every thread shares one queue (and its patch)
+        # rather than patching enqueue_job separately
+        job_queue = mocking.JobQueue(workers)
+        flask_app = flask.current_app._get_current_object() if flask.has_app_context() else None
+        pool = ThreadPool(workers)
+        try:
+            pool.map(lambda item: _create_resources(item, job_queue, flask_app),
+                     list(resources.items()))
+        finally:
+            pool.close()
+            pool.join()
+            job_queue.close()
+    else:
+        for item in resources.items():
+            _create_resources(item)
+    return df
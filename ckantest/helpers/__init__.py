@@ -4,5 +4,12 @@
 # This file is part of ckantest
 # Created by the Natural History Museum in London, UK
 
-from . import plugins, mocking, routes, containers
-from .config import Configurer
+from ckantest._lazy import lazy
+
+# submodules (and their dependencies, e.g. ckan and mock) are only imported when used
+lazy(__name__, globals(),
+     submodules=[u'plugins', u'mocking', u'routes', u'containers', u'database', u'benchmark',
+                 u'load', u'profiling', u'counting', u'search', u'memory', u'frozen'],
+     attributes={
+         u'Configurer': u'.config'
+         })
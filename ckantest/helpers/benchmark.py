@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import argparse
+import json
+import os
+import sys
+
+
+def percentile(values, p):
+    '''
+    Returns the pth percentile of a list of values using linear interpolation.
+    :param values: a sorted list of numbers
+    :param p: the percentile (0-100)
+    '''
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarise(timings, total=None):
+    '''
+    Calculates latency statistics for a list of timings.
+    :param timings: a list of durations in seconds
+    :param total: the wall-clock time taken for all of them; defaults to their sum
+    :return: dict
+    '''
+    ordered = sorted(timings)
+    total = sum(ordered) if total is None else total
+    return {
+        u'n': len(ordered),
+        u'mean': sum(ordered) / len(ordered) if ordered else None,
+        u'min': ordered[0] if ordered else None,
+        u'max': ordered[-1] if ordered else None,
+        u'p50': percentile(ordered, 50),
+        u'p95': percentile(ordered, 95),
+        u'p99': percentile(ordered, 99),
+        u'throughput': len(ordered) / total if total else None
+        }
+
+
+class Results(object):
+    '''
+    A collection of named benchmark results that can be saved to and loaded from JSON.
+    '''
+
+    def __init__(self, results=None):
+        self.results = results or {}
+
+    def add(self, name, timings, total=None, **meta):
+        '''
+        Summarises a set of timings and stores them under the given name.
+        :param meta: any extra information to store with the result, e.g. fixture size
+        :return: the summary dict
+        '''
+        result = summarise(timings, total)
+        result.update(meta)
+        self.results[name] = result
+        return result
+
+    def save(self, path):
+        '''
+        Writes the results to a JSON file, merging them with any already in it.
+        '''
+        existing = Results.load(path).results if os.path.exists(path) else {}
+        existing.update(self.results)
+        with open(path, u'w') as f:
+            json.dump(existing, f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, u'r') as f:
+            return cls(json.load(f))
+
+
+def compare(baseline, current, threshold=0.1, metrics=(u'p50', u'p95', u'p99')):
+    '''
+    Finds results that are slower than the baseline by more than the threshold.
+    :param baseline: the baseline Results
+    :param current: the new Results
+    :param threshold: the allowed proportional slowdown, e.g. 0.1 for 10%
+    :param metrics: the latency statistics to compare
+    :return: list of (name, metric, baseline value, current value) tuples
+    '''
+    regressions = []
+    for name, result in sorted(current.results.items()):
+        base = baseline.results.get(name)
+        if base is None:
+            continue
+        for metric in metrics:
+            old = base.get(metric)
+            new = result.get(metric)
+            if old and new and new > old * (1 + threshold):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=u'Compare ckantest benchmark results.')
+    subparsers = parser.add_subparsers(dest=u'command')
+    compare_parser = subparsers.add_parser(u'compare',
+                                           help=u'Flag regressions against a baseline.')
+    compare_parser.add_argument(u'baseline')
+    compare_parser.add_argument(u'current')
+    compare_parser.add_argument(u'--threshold', type=float, default=0.1,
+                                help=u'Allowed slowdown as a proportion (default 0.1).')
+    args = parser.parse_args(argv)
+    if args.command != u'compare':
+        parser.print_help()
+        return 2
+
+    regressions = compare(Results.load(args.baseline), Results.load(args.current),
+                          args.threshold)
+    for name, metric, old, new in regressions:
+        print(u'REGRESSION {0} {1}: {2:.2f}ms -> {3:.2f}ms ({4:+.0%})'.format(
+            name, metric, old * 1000, new * 1000, new / old - 1))
+    if not regressions:
+        print(u'No regressions.')
+    return 1 if regressions else 0
+
+
+if __name__ == u'__main__':
+    sys.exit(main())
@@ -4,32 +4,128 @@
 # This file is part of ckantest
 # Created by the Natural History Museum in London, UK
 
+import weakref
+from contextlib import contextmanager
+
 from ckan import plugins
 from ckan.plugins import toolkit
 from .plugins import load_datastore
 
+_missing = object()
+
+
+class _Recorder(object):
+    '''
+    Hooks the config class so that every change to the config - whether it's made through a
+    Configurer or directly - is recorded in the current layer of every live Configurer before
+    it happens (except the one making the change while it reverts itself). The hook is
+    installed when the first Configurer is stored and removed when the last one is released.
+    '''
+    configurers = weakref.WeakSet()
+    reverting = None
+    originals = None
+
+    @classmethod
+    def before_change(cls, config, key):
+        if config is not toolkit.config:
+            return
+        for configurer in list(cls.configurers):
+            if configurer is not cls.reverting:
+                configurer._record(key)
+
+    @classmethod
+    def add(cls, configurer):
+        cls.configurers.add(configurer)
+        cls.install()
+
+    @classmethod
+    def remove(cls, configurer):
+        cls.configurers.discard(configurer)
+        if not cls.configurers:
+            cls.uninstall()
+
+    @classmethod
+    def install(cls):
+        if cls.originals is not None:
+            return
+        config_class = type(toolkit.config)
+        if config_class is dict:
+            # builtins can't be patched, so only changes made through Configurers are recorded
+            return
+        original_setitem = config_class.__setitem__
+        original_delitem = config_class.__delitem__
+        original_clear = config_class.clear
+        # only the methods the class defines itself need putting back; the rest are inherited
+        cls.originals = (config_class, dict((name, config_class.__dict__.get(name)) for name in
+                                            (u'__setitem__', u'__delitem__', u'clear')))
+
+        def __setitem__(self, key, value):
+            cls.before_change(self, key)
+            original_setitem(self, key, value)
+
+        def __delitem__(self, key):
+            cls.before_change(self, key)
+            original_delitem(self, key)
+
+        def clear(self):
+            for key in list(self.keys()):
+                cls.before_change(self, key)
+            original_clear(self)
+
+        config_class.__setitem__ = __setitem__
+        config_class.__delitem__ = __delitem__
+        config_class.clear = clear
+
+    @classmethod
+    def uninstall(cls):
+        if cls.originals is None:
+            return
+        config_class, methods = cls.originals
+        for name, method in methods.items():
+            if method is None:
+                delattr(config_class, name)
+            else:
+                setattr(config_class, name, method)
+        cls.originals = None
+
 
 class Configurer(object):
     '''
     A class for easily and consistently accessing, resetting, and otherwise
     manipulating the current config within tests.
+
+    Rather than copying the whole config, it records the original value of each key the
+    first time it's changed (in a stack of layers), so resetting only touches the keys that
+    were changed and removes any that were added.
     '''
 
     def __init__(self, persist=None):
-        self.persist = persist
+        self.persist = persist or {}
         self._blueprints = []
         self._plugins = []
-        self.stored = None
-        self._soft_store = None
+        self._layers = [{}]
+        self._soft_depth = None
         self._changed = {}
         self.store()
         self.reset()
 
     def store(self):
         '''
-        Stores a copy of the current config.
+        Marks the current config as the one to return to when reset() is called, and starts
+        recording changes (until release() is called).
+        '''
+        self._layers = [{}]
+        self._soft_depth = None
+        _Recorder.add(self)
+
+    def release(self, reset=True):
+        '''
+        Stops recording changes, e.g. when the configurer is no longer needed.
+        :param reset: reset the config (and unload the plugins) first
         '''
-        self.stored = toolkit.config.copy()
+        if reset:
+            self.reset()
+        _Recorder.remove(self)
 
     @property
     def current(self):
@@ -39,11 +135,39 @@ class Configurer(object):
         '''
         return toolkit.config
 
+    def _record(self, key):
+        '''
+        Stores the current value of a key in the top layer, if it's not already there.
+        '''
+        layer = self._layers[-1]
+        if key not in layer:
+            layer[key] = toolkit.config[key] if key in toolkit.config else _missing
+
+    def _revert(self, depth):
+        '''
+        Undoes the changes recorded in every layer above the given depth, most recent first.
+        :param depth: the number of layers to keep
+        '''
+        previous = _Recorder.reverting
+        _Recorder.reverting = self
+        try:
+            while len(self._layers) > depth:
+                for key, value in self._layers.pop().items():
+                    if value is _missing:
+                        if key in toolkit.config:
+                            del toolkit.config[key]
+                    else:
+                        toolkit.config[key] = value
+        finally:
+            _Recorder.reverting = previous
+
     def reset(self):
         '''
         Overwrites the current config with the stored config, then reload the persistent settings.
         '''
-        toolkit.config.update(self.stored)
+        self._revert(0)
+        self._layers = [{}]
+        self._soft_depth = None
         for plugin in self._plugins:
             if plugins.plugin_loaded(plugin):
                 plugins.unload(plugin)
@@ -58,6 +182,7 @@ class Configurer(object):
         for key, value in new_values.items():
             if key not in self._changed.keys():
                 self._changed[key] = toolkit.config.get(key, None)
+            self._record(key)
             toolkit.config[key] = value
 
     def remove(self, *keys):
@@ -70,6 +195,7 @@ class Configurer(object):
             if k not in self._changed.keys():
                 self._changed[k] = toolkit.config.get(k, None)
             if k in toolkit.config.keys():
+                self._record(k)
                 del toolkit.config[k]
 
     def undo(self, key):
@@ -84,6 +210,25 @@ class Configurer(object):
             del toolkit.config[key]
         del self._changed[key]
 
+    @contextmanager
+    def override(self, new_values):
+        '''
+        Temporarily updates the config; everything changed inside the block (including the
+        new values) is reverted when it exits. Overrides can be nested.
+
+            with configurer.override({'ckan.site_title': 'Test'}):
+                ...
+
+        :param new_values: A dictionary of config keys and new values.
+        '''
+        depth = len(self._layers)
+        self._layers.append({})
+        try:
+            self.update(new_values)
+            yield self
+        finally:
+            self._revert(depth)
+
     def load_plugins(self, *plugin_names):
         for p in plugin_names:
             if p == u'datastore':
@@ -100,7 +245,19 @@ class Configurer(object):
         # because apparently loading the plugin doesn't add it to the config
         current_plugins = self.current.get(u'ckan.plugins', u'')
         self.update({u'ckan.plugins': u' '.join([current_plugins] + self._plugins)})
-        self._soft_store = self.current.copy()
+        # soft_reset() returns to this point
+        self._soft_depth = len(self._layers)
+        self._layers.append({})
+
+    def reload_plugins(self):
+        '''
+        Loads the plugins again after a reset(), e.g. when going back to this configurer after
+        another one's plugins were loaded in its place.
+        '''
+        plugin_names = self._plugins
+        self._plugins = []
+        self._blueprints = []
+        self.load_plugins(*plugin_names)
 
     def register_blueprints(self, app):
         for blueprint in self._blueprints:
@@ -111,5 +268,10 @@ class Configurer(object):
         Reset without unloading plugins.
         :return:
         '''
-        toolkit.config.update(self._soft_store)
+        if self._soft_depth is None:
+            self._revert(0)
+            self._layers = [{}]
+        else:
+            self._revert(self._soft_depth)
+            self._layers.append({})
         self.update(self.persist)
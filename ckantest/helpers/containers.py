@@ -6,6 +6,8 @@
 
 from ckan.plugins import toolkit
 
+from .frozen import freeze
+
 
 class DictWrapper(object):
     '''
@@ -26,6 +28,12 @@ class DictWrapper(object):
     def get(self, item, default_value=None):
         return self._dict.get(item, default_value)
 
+    def to_dict(self):
+        '''
+        Returns a copy of the stored values without any of the processing in get().
+        '''
+        return dict(self._dict)
+
     def __getitem__(self, item):
         return self.get(item)
 
@@ -37,11 +45,116 @@ class DictWrapper(object):
 
 
 class Packages(DictWrapper):
+    '''
+    Stores package dicts by name and returns the current version of each one when accessed.
+    By default the current versions are cached until they're invalidated (e.g. when the
+    DataFactory changes a package), and values()/items() fetch everything missing from the
+    cache in batched searches. With fresh=True, package_show is called on every access.
+
+    snapshot() returns an immutable version of a package dict that can be shared and used to
+    make changed copies cheaply (see helpers.frozen); get() returns the cached dict itself.
+    '''
+    batch_size = 500  # ids per search query; solr limits the number of boolean clauses
+
+    def __init__(self, fresh=False):
+        super(Packages, self).__init__()
+        self.fresh = fresh
+        self._cache = {}
+        self._ids = {}
+        self._unindexed = set()
+        self._frozen = {}
+
     def get(self, item, default_value=None):
-        pkg_dict = super(Packages, self).get(item, None)
+        key = self._ids.get(item, item)
+        pkg_dict = super(Packages, self).get(key, None)
         if pkg_dict is None:
             return default_value
-        package_id = pkg_dict[u'id']
-        return toolkit.get_action(u'package_show')({u'ignore_auth': True}, {
-            u'id': package_id
+        if not self.fresh and key in self._cache:
+            return self._cache[key]
+        pkg_dict = toolkit.get_action(u'package_show')({u'ignore_auth': True}, {
+            u'id': pkg_dict[u'id']
             })
+        if not self.fresh:
+            self._cache[key] = pkg_dict
+        return pkg_dict
+
+    def snapshot(self, item):
+        '''
+        Returns an immutable snapshot of the current version of a package dict. Snapshots are
+        cached alongside the package dicts, so repeated calls return the same object until the
+        package is invalidated.
+        :param item: the package key
+        :return: FrozenDict, or None if the package isn't stored
+        '''
+        key = self._ids.get(item, item)
+        if self.fresh or key not in self._frozen:
+            pkg_dict = self.get(key)
+            if pkg_dict is None:
+                return None
+            if self.fresh:
+                return freeze(pkg_dict)
+            self._frozen[key] = freeze(pkg_dict)
+        return self._frozen[key]
+
+    def items(self):
+        self._fetch_missing()
+        return [(k, self.get(k)) for k in self.keys()]
+
+    def values(self):
+        self._fetch_missing()
+        return [self.get(k) for k in self.keys()]
+
+    def __setitem__(self, key, value):
+        super(Packages, self).__setitem__(key, value)
+        self._ids[value[u'id']] = key
+        self._cache[key] = value
+        self._frozen.pop(key, None)
+
+    def invalidate(self, *keys):
+        '''
+        Removes packages from the cache so they're fetched again on their next access.
+        :param keys: package names, ids, or keys; if none are given the whole cache is cleared
+        '''
+        if not keys:
+            self._cache.clear()
+            self._frozen.clear()
+        for k in keys:
+            self._cache.pop(self._ids.get(k, k), None)
+            self._frozen.pop(self._ids.get(k, k), None)
+
+    def mark_unindexed(self, key):
+        '''
+        Records that a package's search index entry is out of date, so it's fetched with
+        package_show rather than from the search results.
+        :param key: the package name, id, or key
+        '''
+        self._unindexed.add(self._ids.get(key, key))
+
+    def mark_indexed(self):
+        '''
+        Records that every package's search index entry is up to date.
+        '''
+        self._unindexed.clear()
+
+    def _fetch_missing(self):
+        '''
+        Fetches every package that isn't already cached using as few searches as possible.
+        Anything the search doesn't return (e.g. inactive packages) is left for get() to
+        retrieve individually.
+        '''
+        if self.fresh:
+            return
+        missing = [self._dict[k][u'id'] for k in self._dict.keys() if
+                   k not in self._cache and k not in self._unindexed]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            result = toolkit.get_action(u'package_search')({u'ignore_auth': True}, {
+                u'fq': u'id:(' + u' OR '.join(batch) + u')',
+                u'rows': len(batch),
+                u'include_private': True,
+                u'include_drafts': True
+                })
+            for pkg_dict in result[u'results']:
+                key = self._ids.get(pkg_dict[u'id'])
+                if key is not None:
+                    self._cache[key] = pkg_dict
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import functools
+import re
+from collections import Counter
+
+from sqlalchemy import event
+
+from ckan import logic, model
+
+_whitespace = re.compile(r'\s+')
+_strings = re.compile(r"'(?:[^']|'')*'")
+_numbers = re.compile(r'\b\d+(?:\.\d+)?\b')
+_params = re.compile(r'%\(\w+\)s|%s|:\w+|\?')
+_lists = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def normalise(statement):
+    '''
+    Reduces a SQL statement to its shape by replacing literals and parameters with ? and
+    collapsing IN lists, so that the same query with different values counts as one.
+    :param statement: the SQL string
+    :return: str
+    '''
+    statement = _strings.sub(u'?', statement)
+    statement = _numbers.sub(u'?', statement)
+    statement = _params.sub(u'?', statement)
+    statement = _lists.sub(u'(?...)', statement)
+    return _whitespace.sub(u' ', statement).strip()
+
+
+class CallCounter(object):
+    '''
+    A context manager that counts action calls (by name) and SQL statements (by normalised
+    shape) made inside it, and optionally fails if there are more than allowed:
+
+        with CallCounter(max_queries=10, max_actions={'package_show': 1}) as counter:
+            ...
+
+    Actions are counted by wrapping the entries in CKAN's action registry, so every call
+    that goes through get_action is included, even ones made inside other actions.
+    '''
+
+    def __init__(self, max_queries=None, max_actions=None, engine=None):
+        '''
+        :param max_queries: the maximum number of SQL statements allowed
+        :param max_actions: the maximum number of action calls allowed; either a total or a
+                            dict of maximums by action name
+        :param engine: the engine to count statements on; defaults to the CKAN model's
+        '''
+        self.max_queries = max_queries
+        self.max_actions = max_actions
+        self.engine = engine
+        self.actions = Counter()
+        self.queries = Counter()
+        self._originals = None
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def action_count(self):
+        return sum(self.actions.values())
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.queries[normalise(statement)] += 1
+
+    def _wrap(self, name, action):
+        @functools.wraps(action)
+        def _counted(*args, **kwargs):
+            self.actions[name] += 1
+            return action(*args, **kwargs)
+        return _counted
+
+    def __enter__(self):
+        # make sure the registry has been populated
+        logic.get_action(u'package_show')
+        self._originals = dict(logic._actions)
+        for name, action in self._originals.items():
+            logic._actions[name] = self._wrap(name, action)
+        self._engine = self.engine or model.meta.engine
+        event.listen(self._engine, u'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(self._engine, u'before_cursor_execute', self._on_execute)
+        logic._actions.update(self._originals)
+        self._originals = None
+        if exc_type is None:
+            self.check()
+
+    def failures(self):
+        '''
+        :return: a list of messages describing any limits that were exceeded
+        '''
+        failures = []
+        if self.max_queries is not None and self.query_count > self.max_queries:
+            failures.append(u'{0} SQL statements were executed (max {1})'.format(
+                self.query_count, self.max_queries))
+        if isinstance(self.max_actions, dict):
+            for name, maximum in sorted(self.max_actions.items()):
+                if self.actions[name] > maximum:
+                    failures.append(u'{0} was called {1} times (max {2})'.format(
+                        name, self.actions[name], maximum))
+        elif self.max_actions is not None and self.action_count > self.max_actions:
+            failures.append(u'{0} actions were called (max {1})'.format(self.action_count,
+                                                                       self.max_actions))
+        return failures
+
+    def report(self, limit=10):
+        '''
+        :param limit: the number of statements/actions to list
+        :return: the most repeated statements and actions as a string
+        '''
+        lines = [u'Actions ({0}):'.format(self.action_count)]
+        for name, count in self.actions.most_common(limit):
+            lines.append(u'  {0:>5} x {1}'.format(count, name))
+        lines.append(u'SQL statements ({0}):'.format(self.query_count))
+        for statement, count in self.queries.most_common(limit):
+            lines.append(u'  {0:>5} x {1}'.format(count, statement))
+        return u'\n'.join(lines)
+
+    def check(self):
+        '''
+        Raises an AssertionError if any limits were exceeded.
+        '''
+        failures = self.failures()
+        if failures:
+            raise AssertionError(u'\n'.join(failures + [self.report()]))
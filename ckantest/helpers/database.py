@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import logging
+import os
+import pickle
+import re
+
+from sqlalchemy import MetaData, create_engine, event, inspect, text
+from sqlalchemy.engine.url import make_url
+
+from ckantest.plugins import memory_datastore
+
+from ckan import model
+from ckan.lib import search
+from ckan.plugins import toolkit
+from ckan.tests import helpers
+
+logger = logging.getLogger(u'ckantest')
+
+# the table a statement writes to
+_written_table = re.compile(r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)\s+'
+                            r'(?:ONLY\s+)?(?:"?\w+"?\.)?"?(\w+)"?', re.IGNORECASE)
+
+
+def _row_dict(row):
+    # rows are only accessible as mappings through _mapping from sqlalchemy 1.4
+    return dict(row._mapping) if hasattr(row, u'_mapping') else dict(row.items())
+
+
+class Snapshot(object):
+    '''
+    An in-memory copy of the contents of the CKAN database. Restoring it just deletes and
+    reinserts a handful of rows, which is much quicker than rebuilding the whole schema
+    with reset_db().
+
+    Every table in the database is included (not just the ones in CKAN's model, so tables
+    that extensions define on their own metadata are reset too), along with the values of
+    any postgres sequences.
+    '''
+
+    # reflected tables, by database URL and table names, so restoring doesn't reflect the
+    # schema every time
+    _reflected = {}
+
+    def __init__(self):
+        self.rows = None
+        self.sequences = {}
+        self.fixtures = {}
+
+    @property
+    def taken(self):
+        return self.rows is not None
+
+    def take(self, **fixtures):
+        '''
+        Copies the current contents of every table in the database.
+        :param fixtures: objects created before the snapshot was taken (e.g. the sysadmin
+                         dict) that should be handed back when it's restored
+        '''
+        model.Session.remove()
+        with model.meta.engine.connect() as connection:
+            self.rows = {}
+            for table in self._tables(connection):
+                self.rows[table.name] = [_row_dict(row) for row in
+                                         connection.execute(table.select())]
+            self.sequences = self._sequences(connection)
+        self.fixtures = fixtures
+        logger.debug(u'Took database snapshot ({0} tables).'.format(len(self.rows)))
+
+    def restore(self, tables=None):
+        '''
+        Empties the tables and reinserts the rows from the snapshot.
+        :param tables: names of the tables to restore (along with any tables that reference
+                       them); every table if None
+        :return: dict of the fixtures stored with the snapshot
+        '''
+        if not self.taken:
+            raise ValueError(u'No snapshot has been taken.')
+        model.Session.remove()
+        if tables is not None and not tables:
+            return dict(self.fixtures)
+        with model.meta.engine.begin() as connection:
+            tables = self._tables(connection, tables)
+            for table in reversed(tables):
+                connection.execute(table.delete())
+            for table in tables:
+                rows = self.rows.get(table.name)
+                if rows:
+                    connection.execute(table.insert(), rows)
+            for name, (value, called) in self.sequences.items():
+                connection.execute(text(u'SELECT setval(:name, :value, :called)'),
+                                   {u'name': name, u'value': value, u'called': called})
+        logger.debug(u'Restored database snapshot ({0} tables).'.format(len(tables)))
+        return dict(self.fixtures)
+
+    def save(self, path):
+        '''
+        Writes the snapshot to a file.
+        :param path: the file path
+        '''
+        with open(path, u'wb') as f:
+            pickle.dump({
+                u'rows': self.rows,
+                u'sequences': self.sequences,
+                u'fixtures': self.fixtures
+                }, f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads a snapshot written by save().
+        :param path: the file path
+        :return: Snapshot
+        '''
+        with open(path, u'rb') as f:
+            data = pickle.load(f)
+        instance = cls()
+        instance.rows = data[u'rows']
+        instance.sequences = data.get(u'sequences', {})
+        instance.fixtures = data[u'fixtures']
+        return instance
+
+    def discard(self):
+        '''
+        Forgets the stored rows, e.g. if the schema has changed.
+        '''
+        self.rows = None
+        self.sequences = {}
+        self.fixtures = {}
+
+    @classmethod
+    def _tables(cls, connection, only=None):
+        '''
+        Returns every table in the database, in dependency order.
+        :param only: names of tables to return (with any tables that reference them, which
+                     can't be emptied and refilled without them); every table if None
+        '''
+        names = tuple(sorted(inspect(connection).get_table_names()))
+        key = (repr(connection.engine.url), names)
+        if key not in cls._reflected:
+            metadata = MetaData()
+            metadata.reflect(bind=connection, only=list(names))
+            cls._reflected[key] = metadata.sorted_tables
+        if only is None:
+            return cls._reflected[key]
+        included = set()
+        # referenced tables come first, so one pass picks up every dependent
+        for table in cls._reflected[key]:
+            if table.name in only or any(fk.column.table.name in included
+                                         for fk in table.foreign_keys):
+                included.add(table.name)
+        return [table for table in cls._reflected[key] if table.name in included]
+
+    @staticmethod
+    def _sequences(connection):
+        '''
+        Returns the current value of every sequence in the database (postgres only).
+        :return: dict of qualified sequence names and (last_value, is_called) tuples
+        '''
+        if connection.dialect.name != u'postgresql':
+            return {}
+        sequences = {}
+        query = text(u'SELECT sequence_schema, sequence_name FROM information_schema.sequences')
+        for schema, name in connection.execute(query).fetchall():
+            qualified = u'"{0}"."{1}"'.format(schema, name)
+            row = connection.execute(
+                text(u'SELECT last_value, is_called FROM {0}'.format(qualified))).fetchone()
+            sequences[qualified] = (row[0], row[1])
+        return sequences
+
+
+# a single snapshot shared by every factory and test class in the process
+snapshot = Snapshot()
+
+
+class WriteTracker(object):
+    '''
+    A context manager that records the names of the tables written to (by INSERT, UPDATE,
+    DELETE or TRUNCATE statements) inside it, so only those need restoring afterwards:
+
+        with WriteTracker() as tracker:
+            ...
+        restore_tables(snapshot, tracker.tables)
+    '''
+
+    def __init__(self, engine=None):
+        '''
+        :param engine: the engine to watch; defaults to the CKAN model's
+        '''
+        self.engine = engine
+        self.tables = set()
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        match = _written_table.match(statement)
+        if match:
+            self.tables.add(match.group(1))
+
+    def __enter__(self):
+        self._engine = self.engine or model.meta.engine
+        event.listen(self._engine, u'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(self._engine, u'before_cursor_execute', self._on_execute)
+
+
+def restore_tables(snapshot, tables):
+    '''
+    Restores the given tables from a snapshot and brings the search index back in line:
+    packages created since the snapshot are removed from it and packages that have changed
+    since (according to their metadata_modified) are reindexed.
+    :param snapshot: the Snapshot to restore
+    :param tables: names of the tables that have been written to
+    :return: dict of the fixtures stored with the snapshot
+    '''
+    if not tables:
+        return snapshot.restore(tables)
+    original = dict((row[u'id'], row[u'metadata_modified']) for row in
+                    snapshot.rows.get(u'package', []))
+    current = dict(model.Session.query(model.Package.id, model.Package.metadata_modified))
+    fixtures = snapshot.restore(tables)
+    for package_id in set(current) - set(original):
+        search.clear(package_id)
+    # this includes packages that were purged, which have to go back into the index
+    changed = sorted(i for i in original if current.get(i) != original[i])
+    if changed:
+        search.rebuild(package_ids=changed, defer_commit=True, quiet=True)
+        search.commit()
+    return fixtures
+
+
+def reset(use_snapshot=False):
+    '''
+    Resets the database, either by rebuilding it or by restoring the shared snapshot if one
+    has been taken.
+    :param use_snapshot: restore the snapshot instead of rebuilding (if possible)
+    :return: dict of any fixtures stored with the snapshot (empty if it wasn't used)
+    '''
+    # the in-memory datastore's records belong to resources that are about to be deleted
+    memory_datastore.store.clear()
+    if use_snapshot and snapshot.taken:
+        return snapshot.restore()
+    helpers.reset_db()
+    return {}
+
+
+def worker_id():
+    '''
+    Returns the id of the current pytest-xdist worker (e.g. 'gw0'), or None if the tests
+    aren't running in parallel.
+    '''
+    return os.environ.get(u'PYTEST_XDIST_WORKER')
+
+
+def _url_string(url):
+    # from sqlalchemy 2.0, str() hides the password
+    if hasattr(url, u'render_as_string'):
+        return url.render_as_string(hide_password=False)
+    return str(url)
+
+
+def worker_url(url, worker):
+    '''
+    Derives a separate database URL for a worker: a suffixed file for sqlite or a suffixed
+    database name for anything else (e.g. ckan_test -> ckan_test_gw0).
+    :param url: the original database URL
+    :param worker: the worker id
+    :return: str
+    '''
+    url = make_url(url)
+    database = url.database
+    if url.drivername.startswith(u'sqlite'):
+        if not database or database == u':memory:':
+            # in-memory databases are already private to the process
+            return _url_string(url)
+        root, ext = os.path.splitext(database)
+        database = u'{0}_{1}{2}'.format(root, worker, ext)
+    else:
+        database = u'{0}_{1}'.format(database, worker)
+    if hasattr(url, u'set'):
+        url = url.set(database=database)
+    else:
+        url.database = database
+    return _url_string(url)
+
+
+def create_database(url):
+    '''
+    Creates the database at the given URL if it doesn't already exist. Sqlite creates its
+    files on connection, so this only does anything for postgres.
+    :param url: the database URL
+    '''
+    url = make_url(url)
+    if not url.drivername.startswith(u'postgres'):
+        return
+    name = url.database
+    if hasattr(url, u'set'):
+        url = url.set(database=u'postgres')
+    else:
+        url.database = u'postgres'
+    engine = create_engine(url, isolation_level=u'AUTOCOMMIT')
+    try:
+        with engine.connect() as connection:
+            exists = connection.execute(text(u'SELECT 1 FROM pg_database WHERE datname = :name'),
+                                        {u'name': name}).scalar()
+            if not exists:
+                logger.debug(u'Creating database {0}...'.format(name))
+                connection.execute(text(u'CREATE DATABASE "{0}"'.format(name)))
+    finally:
+        engine.dispose()
+
+
+def isolate_worker(configurer, worker=None):
+    '''
+    Points this process at its own database (and datastore database and search index site
+    id, if set) so it can run tests in parallel with other workers. This should be called
+    before any test classes are set up so that every Configurer stores the worker's config.
+    :param configurer: the Configurer to make the changes through
+    :param worker: the worker id; defaults to the pytest-xdist worker id
+    :return: the worker's database URL, or None if not running as a worker
+    '''
+    worker = worker or worker_id()
+    if worker is None:
+        return None
+    config = toolkit.config
+    if not config.get(u'sqlalchemy.url'):
+        raise ValueError(u'sqlalchemy.url must be set to isolate worker databases.')
+    changes = {}
+    for key in [u'sqlalchemy.url', u'ckan.datastore.write_url', u'ckan.datastore.read_url']:
+        if config.get(key):
+            changes[key] = worker_url(config[key], worker)
+            create_database(changes[key])
+    # the solr index is shared, but queries and clears are filtered by the site id
+    changes[u'ckan.site_id'] = u'{0}_{1}'.format(config.get(u'ckan.site_id', u'default'),
+                                                 worker)
+    configurer.update(changes)
+    model.init_model(create_engine(changes[u'sqlalchemy.url']))
+    # any existing snapshot belongs to the old database
+    snapshot.discard()
+    logger.debug(u'Isolated worker {0} with database {1}.'.format(worker,
+                                                                  changes[u'sqlalchemy.url']))
+    return changes[u'sqlalchemy.url']
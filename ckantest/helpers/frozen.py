@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+'''
+Immutable dicts and lists for package and resource dict snapshots. Changing a snapshot returns
+a new one that only copies the containers on the path to the change and shares everything else
+with the original, so many variants of a large package dict can be made cheaply without any of
+them affecting the others.
+
+They're subclasses of dict and list, so they can be passed to anything that expects a package
+dict (json, validators, etc.) as long as it doesn't try to change it.
+'''
+
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError(u'{0} is immutable; use set() or set_in() to make a changed copy'.format(
+        type(self).__name__))
+
+
+class FrozenDict(dict):
+    '''
+    An immutable dict. Create one with freeze() so its nested dicts and lists are frozen too.
+    '''
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+    __ior__ = _immutable
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def set(self, key, value):
+        '''
+        Returns a copy with one key changed. The other values are shared, not copied.
+        :param key: the key to set
+        :param value: the new value; it's frozen if it isn't already
+        :return: FrozenDict
+        '''
+        items = dict(self)
+        items[key] = freeze(value)
+        return FrozenDict(items)
+
+    def remove(self, *keys):
+        '''
+        Returns a copy without the given keys.
+        :param keys: the keys to remove; missing keys are ignored
+        :return: FrozenDict
+        '''
+        return FrozenDict((k, v) for k, v in self.items() if k not in keys)
+
+    def merge(self, new_values):
+        '''
+        Returns a copy with several keys changed.
+        :param new_values: a dict of keys and new values
+        :return: FrozenDict
+        '''
+        items = dict(self)
+        items.update((k, freeze(v)) for k, v in new_values.items())
+        return FrozenDict(items)
+
+    def set_in(self, path, value):
+        '''
+        Returns a copy with a nested value changed, e.g. set_in(['resources', 0, 'state'],
+        'draft'). Only the dicts and lists along the path are copied.
+        :param path: a sequence of keys (and list indices)
+        :param value: the new value
+        :return: FrozenDict
+        '''
+        return _set_in(self, list(path), freeze(value))
+
+    def update_in(self, path, function):
+        '''
+        Like set_in, but the new value is the result of calling function with the current one.
+        :param path: a sequence of keys (and list indices)
+        :param function: takes the current (frozen) value and returns the new one
+        :return: FrozenDict
+        '''
+        return self.set_in(path, function(get_in(self, path)))
+
+
+class FrozenList(list):
+    '''
+    An immutable list. Create one with freeze() so its nested dicts and lists are frozen too.
+    '''
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = remove = pop = clear = sort = reverse = _immutable
+
+    def __reduce__(self):
+        return type(self), (list(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def set(self, index, value):
+        '''
+        Returns a copy with one item changed. The other items are shared, not copied.
+        :param index: the index to set
+        :param value: the new value; it's frozen if it isn't already
+        :return: FrozenList
+        '''
+        items = list(self)
+        items[index] = freeze(value)
+        return FrozenList(items)
+
+    def map(self, function):
+        '''
+        Returns a copy with function applied to every item, e.g.
+        resources.map(lambda r: r.set('state', 'draft')).
+        :param function: takes an item and returns its replacement
+        :return: FrozenList
+        '''
+        return FrozenList(freeze(function(item)) for item in self)
+
+    def set_in(self, path, value):
+        '''
+        Returns a copy with a nested value changed; see FrozenDict.set_in.
+        :return: FrozenList
+        '''
+        return _set_in(self, list(path), freeze(value))
+
+
+def _set_in(container, path, value):
+    if not path:
+        return value
+    key = path[0]
+    return container.set(key, _set_in(container[key], path[1:], value))
+
+
+def get_in(obj, path, default=None):
+    '''
+    Gets a nested value, e.g. get_in(pkg_dict, ['resources', 0, 'id']).
+    :param obj: a dict or list (frozen or not)
+    :param path: a sequence of keys (and list indices)
+    :param default: returned if any part of the path is missing
+    :return: the value
+    '''
+    for key in path:
+        try:
+            obj = obj[key]
+        except (KeyError, IndexError, TypeError):
+            return default
+    return obj
+
+
+def freeze(obj):
+    '''
+    Returns an immutable version of a dict or list and everything nested inside it. Frozen
+    containers are returned as they are, so freezing a partly frozen structure only copies the
+    parts that aren't already frozen.
+    :param obj: the value to freeze
+    :return: FrozenDict, FrozenList, or the original value if it's neither a dict nor a list
+    '''
+    if isinstance(obj, (FrozenDict, FrozenList)):
+        return obj
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return FrozenList(freeze(v) for v in obj)
+    return obj
+
+
+def thaw(obj):
+    '''
+    Returns a mutable deep copy of a frozen (or partly frozen) structure, e.g. to pass to
+    something that changes the dict it's given.
+    :param obj: the value to thaw
+    :return: dict, list, or the original value if it's neither
+    '''
+    if isinstance(obj, dict):
+        return dict((k, thaw(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [thaw(v) for v in obj]
+    return obj
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import logging
+import random
+import threading
+import timeit
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+
+from ckan import model
+from sqlalchemy import text
+from .benchmark import summarise
+
+logger = logging.getLogger(u'ckantest')
+
+# substrings of error messages that indicate the database was contended
+contention_markers = [u'deadlock', u'lock', u'could not serialize', u'timeout']
+
+
+def histogram(timings, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)):
+    '''
+    Counts timings into cumulative latency buckets (in seconds).
+    :return: list of (upper bound, count) tuples, ending with (None, total)
+    '''
+    ordered = sorted(timings)
+    counts = []
+    i = 0
+    for bound in buckets:
+        while i < len(ordered) and ordered[i] <= bound:
+            i += 1
+        counts.append((bound, i))
+    counts.append((None, len(ordered)))
+    return counts
+
+
+class LoadGenerator(object):
+    '''
+    Fires a mix of API action requests at an in-process test app from a pool of threads and
+    reports throughput, error rate, latency and database contention.
+    '''
+
+    def __init__(self, app, apikey=None):
+        '''
+        :param app: the test app (e.g. TestBase.app)
+        :param apikey: an API key to authorise the requests with (e.g. the sysadmin's)
+        '''
+        self.app = app
+        self.apikey = apikey
+        self._lock = threading.Lock()
+
+    def request(self, action, params=None, method=u'get'):
+        '''
+        Makes one API request.
+        :return: tuple of (success, error message)
+        '''
+        url = str(u'/api/3/action/{0}'.format(action))
+        headers = {}
+        if self.apikey:
+            headers[u'Authorization'] = str(self.apikey)
+        _request = getattr(self.app, method.lower(), self.app.get)
+        response = _request(url, params=params, headers=headers, expect_errors=True)
+        if response.status_int >= 400:
+            return False, response.body.decode(u'utf-8', u'replace')
+        return True, None
+
+    def run(self, mix, concurrency=4, duration=10, seed=0):
+        '''
+        Sends requests until the duration has passed.
+        :param mix: a list of (weight, action, params) or (weight, action, params, method)
+                    tuples; each request picks one at random in proportion to the weights
+        :param concurrency: the number of threads
+        :param duration: how long to run for, in seconds
+        :param seed: the seed for picking requests
+        :return: dict of results
+        '''
+        total_weight = float(sum(m[0] for m in mix))
+        timer = timeit.default_timer
+        deadline = timer() + duration
+        timings = []
+        errors = Counter()
+        contention = Counter()
+        counts = Counter()
+
+        def pick(rng):
+            r = rng.random() * total_weight
+            for entry in mix:
+                r -= entry[0]
+                if r <= 0:
+                    break
+            return entry
+
+        def worker(n):
+            rng = random.Random(u'{0}:{1}'.format(seed, n))
+            local_timings = []
+            try:
+                while timer() < deadline:
+                    entry = pick(rng)
+                    start = timer()
+                    try:
+                        ok, message = self.request(*entry[1:])
+                    except Exception as e:
+                        ok, message = False, u'{0}: {1}'.format(type(e).__name__, e)
+                    local_timings.append(timer() - start)
+                    with self._lock:
+                        counts[entry[1]] += 1
+                        if not ok:
+                            errors[entry[1]] += 1
+                            lowered = (message or u'').lower()
+                            for marker in contention_markers:
+                                if marker in lowered:
+                                    contention[marker] += 1
+            finally:
+                model.Session.remove()
+            with self._lock:
+                timings.extend(local_timings)
+
+        sampler = ContentionSampler()
+        sampler.start()
+        started = timer()
+        pool = ThreadPool(concurrency)
+        try:
+            pool.map(worker, range(concurrency))
+        finally:
+            pool.close()
+            pool.join()
+            sampler.stop()
+        elapsed = timer() - started
+
+        result = summarise(timings, elapsed)
+        total = result[u'n']
+        result.update({
+            u'concurrency': concurrency,
+            u'duration': elapsed,
+            u'requests': dict(counts),
+            u'errors': dict(errors),
+            u'error_rate': sum(errors.values()) / float(total) if total else 0.0,
+            u'histogram': histogram(timings),
+            u'contention': dict(contention, **sampler.results())
+            })
+        logger.debug(u'Load test: {0} requests in {1:.1f}s ({2} errors).'.format(
+            total, elapsed, sum(errors.values())))
+        return result
+
+
+class ContentionSampler(threading.Thread):
+    '''
+    Periodically samples the connection pool and (on postgres) the number of sessions
+    waiting on locks while a load test runs. If sampling fails, the error is raised again from
+    stop() and results() so the load test doesn't report empty contention statistics.
+    '''
+    lock_query = u"SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock'"
+
+    def __init__(self, interval=0.05):
+        super(ContentionSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.samples = 0
+        self.max_checked_out = 0
+        self.saturated_samples = 0
+        self.lock_wait_samples = 0
+        self.max_lock_waits = 0
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        engine = model.meta.engine
+        pool = engine.pool
+        size = pool.size() if hasattr(pool, u'size') else None
+        check_locks = engine.dialect.name == u'postgresql'
+        connection = None
+        try:
+            if check_locks:
+                connection = engine.connect()
+            while not self._stop_event.wait(self.interval):
+                self.samples += 1
+                checked_out = pool.checkedout() if hasattr(pool, u'checkedout') else 0
+                self.max_checked_out = max(self.max_checked_out, checked_out)
+                if size and checked_out >= size:
+                    self.saturated_samples += 1
+                if check_locks:
+                    waiting = connection.execute(text(self.lock_query)).scalar() or 0
+                    if waiting:
+                        self.lock_wait_samples += 1
+                        self.max_lock_waits = max(self.max_lock_waits, waiting)
+        except Exception as e:
+            logger.debug(u'Contention sampling failed: {0}'.format(e))
+            self.error = e
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._raise_error()
+
+    def results(self):
+        '''
+        :return: dict of the sampled contention statistics
+        '''
+        self._raise_error()
+        return {
+            u'samples': self.samples,
+            u'max_connections_checked_out': self.max_checked_out,
+            u'pool_saturated_samples': self.saturated_samples,
+            u'lock_wait_samples': self.lock_wait_samples,
+            u'max_lock_waits': self.max_lock_waits
+            }
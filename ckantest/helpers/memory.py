@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import gc
+import logging
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+logger = logging.getLogger(u'ckantest')
+
+
+class ClassMemory(object):
+    '''
+    The memory growth between a test class's setup and teardown.
+    '''
+
+    def __init__(self, name, growth, top):
+        self.name = name
+        self.growth = growth
+        self.top = top  # list of (size diff, count diff, traceback lines)
+
+
+class MemoryTracker(object):
+    '''
+    Uses tracemalloc to snapshot memory before each test class is set up and after it's torn
+    down, attributing any growth to the places it was allocated so that classes that don't
+    release their memory can be found.
+    '''
+
+    def __init__(self, threshold=1024 * 1024, frames=10, top=5):
+        '''
+        :param threshold: growth in bytes above which a class is flagged as leaking
+        :param frames: the number of frames to keep for each allocation
+        :param top: the number of allocation sites to keep for each class
+        '''
+        if tracemalloc is None:
+            raise RuntimeError(u'Memory tracking needs tracemalloc (python 3.4+).')
+        self.threshold = threshold
+        self.frames = frames
+        self.top = top
+        self.classes = []
+        self._before = {}
+        self._filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__, all_frames=True),
+            tracemalloc.Filter(False, __file__, all_frames=True),
+            tracemalloc.Filter(False, u'<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, u'<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, u'<unknown>')
+            ]
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _snapshot(self):
+        gc.collect()
+        return tracemalloc.take_snapshot().filter_traces(self._filters)
+
+    def class_started(self, name):
+        self.start()
+        self._before[name] = self._snapshot()
+
+    def class_finished(self, name):
+        before = self._before.pop(name, None)
+        if before is None:
+            return None
+        stats = self._snapshot().compare_to(before, u'traceback')
+        growth = sum(s.size_diff for s in stats)
+        top = [(s.size_diff, s.count_diff, s.traceback.format()) for s in stats[:self.top] if
+               s.size_diff > 0]
+        result = ClassMemory(name, growth, top)
+        self.classes.append(result)
+        if growth > self.threshold:
+            logger.warning(u'{0} grew memory by {1:.1f}KiB.'.format(name, growth / 1024.0))
+        return result
+
+    @property
+    def leaking(self):
+        '''
+        :return: the classes that grew memory by more than the threshold, largest first
+        '''
+        return sorted([c for c in self.classes if c.growth > self.threshold],
+                      key=lambda c: -c.growth)
+
+    def report(self, limit=10):
+        '''
+        :return: a report of the classes with the most growth as a string
+        '''
+        lines = [u'{0:>12}  {1}'.format(u'growth', u'class')]
+        for c in sorted(self.classes, key=lambda c: -c.growth)[:limit]:
+            flag = u'  LEAK' if c.growth > self.threshold else u''
+            lines.append(u'{0:>10.1f}KiB  {1}{2}'.format(c.growth / 1024.0, c.name, flag))
+        for c in self.leaking[:limit]:
+            lines.append(u'')
+            lines.append(u'{0} allocation sites:'.format(c.name))
+            for size, count, frames in c.top:
+                lines.append(u'  +{0:.1f}KiB in {1} blocks'.format(size / 1024.0, count))
+                lines.extend(u'    ' + f for f in frames)
+        return u'\n'.join(lines)
+
+
+# the tracker used by TestBase, if tracking is enabled
+tracker = None
+
+
+def enable(**kwargs):
+    '''
+    Starts tracking the memory of each TestBase class.
+    :param kwargs: passed to MemoryTracker
+    :return: the MemoryTracker
+    '''
+    global tracker
+    tracker = MemoryTracker(**kwargs)
+    tracker.start()
+    return tracker
+
+
+def disable():
+    global tracker
+    if tracker is not None:
+        tracker.stop()
+    tracker = None
@@ -4,19 +4,27 @@
 # This file is part of ckantest
 # Created by the Natural History Museum in London, UK
 
-import beaker
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 
-import mock
+from ckantest._lazy import module_dict, module_getattr
 
 
 def session():
+    import beaker.session
+
     return beaker.session.Session({})
 
 
 class Patches(object):
     @classmethod
     def sync_queue(self):
-        def _synchronous_enqueue_job(job_func, args=None, kwargs=None, title=None, queue=None):
+        import mock
+
+        def _synchronous_enqueue_job(job_func, args=None, kwargs=None, title=None, queue=None,
+                                     rq_kwargs=None):
             '''
             Synchronous mock for ``ckan.plugins.toolkit.enqueue_job``.
             From https://docs.ckan.org/en/2.8/maintaining/background-tasks.html
@@ -30,6 +38,222 @@ class Patches(object):
                           side_effect=_synchronous_enqueue_job)
 
 
+def _run_job(job_func, args, kwargs, in_thread):
+    '''
+    Runs a job and times it. Defined at module level so it can be pickled for process pools.
+    :return: tuple of (result, start time, end time, error message)
+    '''
+    started = time.time()
+    try:
+        return job_func(*args, **kwargs), started, time.time(), None
+    except Exception as e:
+        return None, started, time.time(), u'{0}: {1}'.format(type(e).__name__, e)
+    finally:
+        if in_thread:
+            # each thread has its own scoped session, which would otherwise be left open
+            from ckan import model
+            model.Session.remove()
+
+
+class Job(object):
+    '''
+    A job enqueued on a JobQueue.
+    '''
+
+    def __init__(self, job_func, args, kwargs, title, queue, rq_kwargs=None):
+        self.job_func = job_func
+        self.args = args
+        self.kwargs = kwargs
+        self.title = title
+        self.queue = queue
+        # kept so tests can check them, but not applied (e.g. jobs can't be timed out)
+        self.rq_kwargs = rq_kwargs or {}
+        # the thread that enqueued the job
+        self.thread = threading.current_thread().ident
+        self.enqueued = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self._async = None
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    @property
+    def duration(self):
+        return None if self.finished is None else self.finished - self.started
+
+    @property
+    def wait_time(self):
+        return None if self.started is None else self.started - self.enqueued
+
+    def _complete(self, outcome):
+        self.result, self.started, self.finished, self.error = outcome
+
+    def _fail(self, error):
+        '''
+        Finishes a job that failed before it could run (e.g. because it couldn't be pickled).
+        '''
+        now = time.time()
+        self._complete((None, now, now, u'{0}: {1}'.format(type(error).__name__, error)))
+
+
+class JobQueue(object):
+    '''
+    An in-memory stand-in for CKAN's background job queue. Unlike Patches.sync_queue(), jobs
+    are kept in named queues and run concurrently on a pool of worker threads (or processes),
+    so they can finish in a different order to the one they were enqueued in.
+    '''
+
+    def __init__(self, workers=4, processes=False):
+        '''
+        :param workers: the number of workers
+        :param processes: use a process pool instead of threads (jobs and their arguments
+                          must then be picklable)
+        '''
+        # imported here because multiprocessing is slow to import
+        import multiprocessing
+        from multiprocessing.pool import ThreadPool
+
+        self.workers = workers
+        self.processes = processes
+        self.queues = defaultdict(list)
+        self._lock = threading.Lock()
+        self._pool = multiprocessing.Pool(workers) if processes else ThreadPool(workers)
+        self._patcher = None
+        self._mock = None
+        self._patched = 0
+
+    def enqueue(self, job_func, args=None, kwargs=None, title=None, queue=None,
+                rq_kwargs=None):
+        '''
+        Mock for ``ckan.plugins.toolkit.enqueue_job``; submits the job to the pool. Any
+        rq_kwargs (e.g. timeout) are stored on the job but otherwise ignored.
+        :return: Job
+        '''
+        job = Job(job_func, args or [], kwargs or {}, title, queue or u'default', rq_kwargs)
+        with self._lock:
+            self.queues[job.queue].append(job)
+        job._async = self._pool.apply_async(_run_job,
+                                            (job_func, job.args, job.kwargs, not self.processes),
+                                            callback=job._complete)
+        return job
+
+    @contextmanager
+    def patch(self):
+        '''
+        Patches ``ckan.plugins.toolkit.enqueue_job`` to add jobs to this queue. It can be
+        entered from several threads at once: the patch is applied by the first and removed
+        when the last one exits, so the threads can't restore each other's mocks.
+        '''
+        import mock
+
+        with self._lock:
+            if not self._patched:
+                self._patcher = mock.patch(u'ckan.plugins.toolkit.enqueue_job',
+                                           side_effect=self.enqueue)
+                self._mock = self._patcher.start()
+            self._patched += 1
+        try:
+            yield self._mock
+        finally:
+            with self._lock:
+                self._patched -= 1
+                if not self._patched:
+                    self._patcher.stop()
+                    self._patcher = None
+
+    def jobs(self, queue=None, own=False):
+        '''
+        :param queue: the queue name; all queues if None
+        :param own: only return the jobs enqueued by the calling thread
+        :return: list of jobs, in the order they were enqueued
+        '''
+        with self._lock:
+            if queue is not None:
+                jobs = list(self.queues.get(queue, []))
+            else:
+                jobs = [j for q in self.queues.values() for j in q]
+        if own:
+            thread = threading.current_thread().ident
+            jobs = [j for j in jobs if j.thread == thread]
+        return jobs
+
+    def wait(self, queue=None, timeout=None, own=False):
+        '''
+        Blocks until every job (in the given queue, or all queues) has finished.
+        :param queue: the queue name; all queues if None
+        :param timeout: the maximum number of seconds to wait for in total
+        :param own: only wait for the jobs enqueued by the calling thread, e.g. when several
+                    threads share the queue
+        :return: list of the finished jobs
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        jobs = self.jobs(queue, own)
+        for job in jobs:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            job._async.wait(remaining)
+            if not job._async.ready():
+                raise RuntimeError(u'Timed out waiting for job {0}.'.format(job.title))
+            if not job.done and not job._async.successful():
+                # the task failed outside _run_job, so the callback will never run
+                try:
+                    job._async.get(0)
+                except Exception as e:
+                    job._fail(e)
+            # the callback runs just after the result becomes available
+            while not job.done:
+                if deadline is not None and time.time() > deadline:
+                    raise RuntimeError(u'Timed out waiting for job {0}.'.format(job.title))
+                time.sleep(0.001)
+        return jobs
+
+    def drain(self, queue=None, timeout=None):
+        '''
+        Waits for the jobs to finish and removes them from the queue(s).
+        :return: list of the removed jobs
+        '''
+        jobs = self.wait(queue, timeout)
+        finished = set(id(j) for j in jobs)
+        with self._lock:
+            for name in list(self.queues.keys()):
+                self.queues[name] = [j for j in self.queues[name] if id(j) not in finished]
+        return jobs
+
+    def stats(self, queue=None):
+        '''
+        Timing statistics for finished jobs by queue name.
+        :return: dict of queue name -> dict of statistics (in seconds)
+        '''
+        by_queue = defaultdict(list)
+        for job in self.jobs(queue):
+            if job.done:
+                by_queue[job.queue].append(job)
+        stats = {}
+        for name, jobs in by_queue.items():
+            durations = [j.duration for j in jobs]
+            span = max(j.finished for j in jobs) - min(j.enqueued for j in jobs)
+            stats[name] = {
+                u'jobs': len(jobs),
+                u'errors': len([j for j in jobs if j.error]),
+                u'total': sum(durations),
+                u'mean': sum(durations) / len(durations),
+                u'max': max(durations),
+                u'mean_wait': sum(j.wait_time for j in jobs) / len(jobs),
+                u'throughput': len(jobs) / span if span else None
+                }
+        return stats
+
+    def close(self):
+        '''
+        Waits for any remaining jobs and shuts the pool down.
+        '''
+        self._pool.close()
+        self._pool.join()
+
+
 class SimpleMock(object):
     '''A really basic mock class that just implements the attributes passed to it.'''
     def __init__(self, **k):
@@ -37,6 +261,256 @@ class SimpleMock(object):
             setattr(self, i, k[i])
 
 
-class Response(mock.MagicMock):
-    def raise_for_status(self):
-        pass
\ No newline at end of file
+class CassetteError(Exception):
+    '''
+    Raised when a request isn't in a cassette that's being replayed.
+    '''
+    pass
+
+
+def _normalise_url(url):
+    '''
+    Lowercases the scheme and host, sorts the query parameters and drops any fragment.
+    '''
+    try:
+        from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+    except ImportError:
+        from urllib import urlencode
+        from urlparse import parse_qsl, urlsplit, urlunsplit
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or u'/', query,
+                       u''))
+
+
+def _normalise_body(body):
+    '''
+    Hashes a request body, parsing it as JSON first (if possible) so that key order doesn't
+    matter.
+    '''
+    import hashlib
+    import json
+
+    if body is None:
+        return None
+    if not isinstance(body, bytes):
+        body = body.encode(u'utf-8') if hasattr(body, u'encode') else bytes(body)
+    try:
+        body = json.dumps(json.loads(body.decode(u'utf-8')), sort_keys=True).encode(u'utf-8')
+    except ValueError:
+        pass
+    return hashlib.sha1(body).hexdigest()
+
+
+class Cassette(object):
+    '''
+    Records outbound HTTP requests made through ``requests`` or ``urllib`` to a gzipped
+    JSON-lines file, and replays them from an in-memory index keyed by the normalised method,
+    URL and body, so tests don't need the network or hand-written Response mocks:
+
+        with Cassette('tests/cassettes/gbif.jsonl.gz'):
+            ...
+
+    Identical requests are replayed in the order they were recorded (repeating the last).
+    '''
+    modes = [u'record', u'replay', u'auto']
+
+    def __init__(self, path, mode=u'auto'):
+        '''
+        :param path: the cassette file
+        :param mode: 'record' makes real requests and overwrites the cassette, 'replay' only
+                     serves recorded responses (raising CassetteError for anything else) and
+                     'auto' replays if the cassette exists and records otherwise
+        '''
+        import os
+
+        if mode not in self.modes:
+            raise ValueError(u'Unknown cassette mode: ' + mode)
+        if mode == u'auto':
+            mode = u'replay' if os.path.exists(path) else u'record'
+        self.path = path
+        self.mode = mode
+        self.index = {}
+        self.recorded = []
+        self._played = defaultdict(int)
+        self._patches = []
+        if mode == u'replay':
+            self.load()
+
+    @staticmethod
+    def key(method, url, body=None):
+        return method.upper(), _normalise_url(url), _normalise_body(body)
+
+    def load(self):
+        import gzip
+        import json
+
+        with gzip.open(self.path, u'rb') as f:
+            for line in f:
+                self._add(json.loads(line.decode(u'utf-8')))
+
+    def save(self):
+        import gzip
+        import json
+        import os
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with gzip.open(self.path, u'wb') as f:
+            for entry in self.recorded:
+                f.write((json.dumps(entry, sort_keys=True) + u'\n').encode(u'utf-8'))
+
+    def _add(self, entry):
+        key = (entry[u'method'], entry[u'url'], entry[u'body'])
+        self.index.setdefault(key, []).append(entry)
+
+    def _record(self, method, url, body, status, headers, content):
+        import base64
+
+        entry = {
+            u'method': method.upper(),
+            u'url': _normalise_url(url),
+            u'body': _normalise_body(body),
+            u'status': status,
+            u'headers': dict(headers),
+            u'content': base64.b64encode(content).decode(u'ascii')
+            }
+        self.recorded.append(entry)
+        self._add(entry)
+
+    def _play(self, method, url, body):
+        '''
+        :return: tuple of (status, headers, content) for a recorded request
+        '''
+        import base64
+
+        key = self.key(method, url, body)
+        entries = self.index.get(key)
+        if not entries:
+            raise CassetteError(u'No recorded response for {0} {1} in {2}'.format(
+                key[0], key[1], self.path))
+        i = min(self._played[key], len(entries) - 1)
+        self._played[key] += 1
+        entry = entries[i]
+        return entry[u'status'], entry[u'headers'], base64.b64decode(entry[u'content'])
+
+    def _requests_send(self, original):
+        cassette = self
+
+        def send(session, request, **kwargs):
+            if cassette.mode == u'record':
+                response = original(session, request, **kwargs)
+                cassette._record(request.method, request.url, request.body,
+                                 response.status_code, response.headers, response.content)
+                return response
+            import io
+            import requests
+            from requests.structures import CaseInsensitiveDict
+
+            status, headers, content = cassette._play(request.method, request.url,
+                                                      request.body)
+            response = requests.models.Response()
+            response.status_code = status
+            response.headers = CaseInsensitiveDict(headers)
+            response._content = content
+            # the content has already been read, so iter_content() and iter_lines() (used for
+            # streaming downloads) iterate over it rather than trying to read from raw
+            response._content_consumed = True
+            response.raw = io.BytesIO(content)
+            response.url = request.url
+            response.request = request
+            response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            return response
+
+        return send
+
+    def _urllib_open(self, original):
+        cassette = self
+
+        def open_url(opener, fullurl, data=None, *args, **kwargs):
+            import io
+            try:
+                from urllib.response import addinfourl
+                from email.message import Message
+
+                new_headers = Message
+            except ImportError:
+                from urllib import addinfourl
+                from httplib import HTTPMessage
+
+                # python 2's header messages are parsed from a file
+                def new_headers():
+                    return HTTPMessage(io.BytesIO())
+
+            if isinstance(fullurl, str) or not hasattr(fullurl, u'get_full_url'):
+                url, method, body = fullurl, u'POST' if data else u'GET', data
+            else:
+                url = fullurl.get_full_url()
+                body = data if data is not None else fullurl.data
+                method = fullurl.get_method()
+            if cassette.mode == u'record':
+                response = original(opener, fullurl, data, *args, **kwargs)
+                content = response.read()
+                headers = response.info()
+                cassette._record(method, url, body, response.getcode(), headers.items(),
+                                 content)
+                status = response.getcode()
+            else:
+                status, headers_dict, content = cassette._play(method, url, body)
+                headers = new_headers()
+                for name, value in headers_dict.items():
+                    headers[name] = value
+            return addinfourl(io.BytesIO(content), headers, url, status)
+
+        return open_url
+
+    def __enter__(self):
+        import mock
+
+        try:
+            import requests
+
+            original = requests.Session.send
+            self._patches.append(mock.patch.object(requests.Session, u'send',
+                                                   self._requests_send(original)))
+        except ImportError:
+            pass
+        try:
+            from urllib.request import OpenerDirector
+        except ImportError:
+            from urllib2 import OpenerDirector
+        self._patches.append(mock.patch.object(OpenerDirector, u'open',
+                                               self._urllib_open(OpenerDirector.open)))
+        for p in self._patches:
+            p.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for p in reversed(self._patches):
+            p.stop()
+        self._patches = []
+        if self.mode == u'record':
+            self.save()
+
+
+def _response_class():
+    import mock
+
+    class Response(mock.MagicMock):
+        def raise_for_status(self):
+            pass
+
+    return Response
+
+
+def _getattr(name):
+    # Response subclasses MagicMock, so it's only defined when it's first used to avoid
+    # importing mock for everything else in this module
+    if name == u'Response':
+        module_dict(__name__)[u'Response'] = _response_class()
+        return module_dict(__name__)[u'Response']
+    raise AttributeError(u'module {0} has no attribute {1}'.format(__name__, name))
+
+
+module_getattr(__name__, globals(), _getattr)
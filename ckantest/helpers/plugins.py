@@ -7,11 +7,25 @@
 import logging
 
 from ckan import plugins
+from ckan.plugins import toolkit
 
 logger = logging.getLogger(u'ckantest')
 
 
-def load_datastore():
+def load_datastore(memory=None):
+    '''
+    Loads a datastore plugin: the in-memory stand-in if requested, otherwise the core
+    datastore, falling back to the versioned datastore.
+    :param memory: load the in-memory datastore; defaults to the ckantest.datastore config
+                   option being set to 'memory'
+    :return: the name of the plugin that was loaded
+    '''
+    if memory is None:
+        memory = toolkit.config.get(u'ckantest.datastore') == u'memory'
+    if memory:
+        plugins.load(u'memory_datastore')
+        logger.debug(u'Loaded in-memory datastore.')
+        return u'memory_datastore'
     try:
         plugins.load(u'datastore')
         logger.debug(u'Loaded datastore.')
@@ -29,3 +43,5 @@ def unload_datastore():
         plugins.unload(u'datastore')
     if plugins.plugin_loaded(u'versioned_datastore'):
         plugins.unload(u'versioned_datastore')
+    if plugins.plugin_loaded(u'memory_datastore'):
+        plugins.unload(u'memory_datastore')
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import cProfile
+import functools
+import heapq
+import io
+import pstats
+import timeit
+from collections import defaultdict
+from contextlib import contextmanager
+
+# (module path, attribute path, phase name) for everything timed by FixtureProfiler.install()
+default_targets = [
+    (u'ckantest.helpers.config', u'Configurer.load_plugins', u'load_plugins'),
+    (u'ckantest.helpers.config', u'Configurer.register_blueprints', u'register_blueprints'),
+    (u'ckantest.helpers.config', u'Configurer.reset', u'config_reset'),
+    (u'ckantest.helpers.config', u'Configurer.soft_reset', u'config_soft_reset'),
+    (u'ckan.tests.helpers', u'_get_test_app', u'get_test_app'),
+    (u'ckan.tests.helpers', u'reset_db', u'reset_db'),
+    (u'ckantest.helpers.database', u'Snapshot.take', u'snapshot_take'),
+    (u'ckantest.helpers.database', u'Snapshot.restore', u'snapshot_restore'),
+    (u'ckantest.factories.data', u'DataFactory.package', u'package'),
+    (u'ckantest.factories.data', u'DataFactory.create_packages', u'create_packages'),
+    (u'ckantest.factories.data', u'DataFactory.resource', u'resource'),
+    (u'ckantest.factories.data', u'DataFactory.load_records', u'load_records'),
+    (u'ckantest.factories.data', u'DataFactory.organisation', u'organisation'),
+    (u'ckantest.factories.data', u'DataFactory.user', u'user'),
+    (u'ckantest.factories.data', u'DataFactory.activate_package', u'activate_package'),
+    (u'ckantest.factories.data', u'DataFactory.deactivate_package', u'deactivate_package'),
+    (u'ckantest.factories.data', u'DataFactory.remove_resources', u'remove_resources'),
+    ]
+
+
+class FixtureProfiler(object):
+    '''
+    Times the setup and teardown phases of each test class (loading plugins, creating the
+    app, resetting the database, creating data, etc.) and optionally keeps cProfile stats
+    for the slowest calls.
+    '''
+
+    def __init__(self, profile_slowest=0):
+        '''
+        :param profile_slowest: the number of slowest top-level phase calls to keep cProfile
+                                stats for (0 to disable cProfile entirely)
+        '''
+        self.profile_slowest = profile_slowest
+        self.current = u'<no class>'
+        # (class name, phase stack) -> [inclusive seconds, self seconds, calls]
+        self.timings = defaultdict(lambda: [0.0, 0.0, 0])
+        self.profiles = []  # heap of (duration, counter, class name, phase, pstats.Stats)
+        self._stack = []
+        self._patched = []
+        self._counter = 0
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Times a block of code as the named phase of the current class.
+        '''
+        self._stack.append([name, 0.0])
+        top_level = len(self._stack) == 1
+        profile = cProfile.Profile() if top_level and self.profile_slowest else None
+        timer = timeit.default_timer
+        start = timer()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            duration = timer() - start
+            name, children = self._stack.pop()
+            path = tuple(p[0] for p in self._stack) + (name,)
+            entry = self.timings[(self.current, path)]
+            entry[0] += duration
+            entry[1] += duration - children
+            entry[2] += 1
+            if self._stack:
+                self._stack[-1][1] += duration
+            if profile is not None:
+                self._keep_profile(duration, name, profile)
+
+    def _keep_profile(self, duration, name, profile):
+        self._counter += 1
+        item = (duration, self._counter, self.current, name, pstats.Stats(profile))
+        if len(self.profiles) < self.profile_slowest:
+            heapq.heappush(self.profiles, item)
+        elif duration > self.profiles[0][0]:
+            heapq.heapreplace(self.profiles, item)
+
+    def wrap(self, function, name):
+        '''
+        Returns a version of the function that is timed as the named phase.
+        '''
+        @functools.wraps(function)
+        def _wrapped(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return _wrapped
+
+    def install(self, targets=None):
+        '''
+        Patches the target functions so that they're timed.
+        :param targets: a list of (module path, attribute path, phase name) tuples; defaults
+                        to default_targets
+        '''
+        import importlib
+
+        for module_path, attribute_path, name in targets or default_targets:
+            owner = importlib.import_module(module_path)
+            parts = attribute_path.split(u'.')
+            for part in parts[:-1]:
+                owner = getattr(owner, part)
+            # look in __dict__ so staticmethods/classmethods are restored as they were
+            original = owner.__dict__[parts[-1]]
+            setattr(owner, parts[-1], self.wrap(getattr(owner, parts[-1]), name))
+            self._patched.append((owner, parts[-1], original))
+
+    def uninstall(self):
+        '''
+        Restores everything patched by install().
+        '''
+        for owner, attribute, original in reversed(self._patched):
+            setattr(owner, attribute, original)
+        self._patched = []
+
+    def ranked(self):
+        '''
+        Totals the time spent in each top-level phase by class.
+        :return: list of (seconds, calls, class name, phase) tuples, slowest first
+        '''
+        rows = [(v[0], v[2], cls, path[0]) for (cls, path), v in self.timings.items() if
+                len(path) == 1]
+        return sorted(rows, reverse=True)
+
+    def report(self, limit=20):
+        '''
+        :param limit: the number of rows to include
+        :return: the ranked report as a string
+        '''
+        lines = [u'{0:>10}  {1:>6}  {2}'.format(u'seconds', u'calls', u'class / phase')]
+        for seconds, calls, cls, phase in self.ranked()[:limit]:
+            lines.append(u'{0:>10.3f}  {1:>6}  {2} / {3}'.format(seconds, calls, cls, phase))
+        totals = defaultdict(float)
+        for seconds, _, _, phase in self.ranked():
+            totals[phase] += seconds
+        lines.append(u'')
+        lines.append(u'totals by phase:')
+        for phase, seconds in sorted(totals.items(), key=lambda x: -x[1]):
+            lines.append(u'{0:>10.3f}  {1}'.format(seconds, phase))
+        for duration, _, cls, phase, stats in sorted(self.profiles, reverse=True):
+            lines.append(u'')
+            lines.append(u'profile of {0} / {1} ({2:.3f}s):'.format(cls, phase, duration))
+            stream = io.StringIO() if str is not bytes else io.BytesIO()
+            stats.stream = stream
+            stats.sort_stats(u'cumulative').print_stats(15)
+            lines.append(stream.getvalue())
+        return u'\n'.join(lines)
+
+    def write_folded(self, path):
+        '''
+        Writes the self time of every phase stack in the folded format used by flamegraph.pl
+        and speedscope, in microseconds. The functions in any kept cProfile stats are
+        written under a separate 'cProfile' root so they aren't counted twice.
+        :param path: the file to write to
+        '''
+        with io.open(path, u'w', encoding=u'utf-8') as f:
+            for (cls, stack), (_, self_seconds, _) in sorted(self.timings.items()):
+                f.write(u'{0} {1}\n'.format(u';'.join((cls,) + stack),
+                                            int(self_seconds * 1e6)))
+            for _, _, cls, phase, stats in self.profiles:
+                for (filename, line, function), values in stats.stats.items():
+                    total_time = values[2]
+                    if total_time <= 0:
+                        continue
+                    frame = u'{0}:{1}:{2}'.format(filename, line, function)
+                    f.write(u'cProfile;{0};{1};{2} {3}\n'.format(
+                        cls, phase, frame.replace(u' ', u'_'), int(total_time * 1e6)))
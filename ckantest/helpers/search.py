@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import json
+import re
+import threading
+from contextlib import contextmanager
+
+import mock
+
+from ckan import model
+from ckan.lib import plugins as lib_plugins
+from ckan.plugins import toolkit
+
+# clauses like +field:value, -field:"some value", field:(a OR b), or bare words
+_clause = re.compile(r'([+-]?)(?:([\w.]+):)?(\([^)]*\)|"[^"]*"|\S+)')
+
+
+def _values(term):
+    '''
+    Splits a query term into the values it matches, e.g. '(a OR "b c")' -> ['a', 'b c'].
+    '''
+    term = term.strip()
+    if term.startswith(u'(') and term.endswith(u')'):
+        parts = re.split(r'\s+OR\s+', term[1:-1].strip())
+    else:
+        parts = [term]
+    return [p.strip().strip(u'"') for p in parts if p.strip()]
+
+
+def parse(query):
+    '''
+    Parses a (very) small subset of the solr query syntax.
+    :param query: the query string
+    :return: list of (required, field, values) tuples, where required is True (must match),
+             False (must not match), or None (free text that must match)
+    '''
+    clauses = []
+    for sign, field, term in _clause.findall(query or u''):
+        if term in (u'AND', u'OR') and not field:
+            continue
+        if field is None or field == u'':
+            field = None
+        if field is None and term == u'*:*':
+            continue
+        values = _values(term)
+        if values == [u'*'] or values == [u'*:*']:
+            continue
+        clauses.append((sign != u'-', field, values))
+    return clauses
+
+
+class MemorySearchIndex(object):
+    '''
+    An in-memory stand-in for the solr package index. While patch() is active, packages
+    are indexed into a dict and package_search is answered from it, supporting field:value
+    clauses (with +, - and OR lists), free text on the main text fields, sorting, paging,
+    facet counts and permission labels, plus the site id and active state filters that ckan
+    adds to every query - enough for tests that don't rely on solr's
+    analysis or ranking.
+    '''
+    text_fields = [u'name', u'title', u'notes', u'author', u'tags', u'res_name',
+                   u'res_description']
+
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def document(self, pkg_dict):
+        '''
+        Flattens a package dict into the fields the real index would hold.
+        '''
+        organization = pkg_dict.get(u'organization') or {}
+        resources = pkg_dict.get(u'resources', [])
+        doc = {
+            u'id': pkg_dict[u'id'],
+            u'site_id': toolkit.config.get(u'ckan.site_id'),
+            u'name': pkg_dict.get(u'name'),
+            u'title': pkg_dict.get(u'title'),
+            u'notes': pkg_dict.get(u'notes'),
+            u'author': pkg_dict.get(u'author'),
+            u'state': pkg_dict.get(u'state'),
+            u'dataset_type': pkg_dict.get(u'type'),
+            u'capacity': u'private' if pkg_dict.get(u'private') else u'public',
+            u'owner_org': pkg_dict.get(u'owner_org'),
+            u'organization': organization.get(u'name'),
+            u'metadata_created': pkg_dict.get(u'metadata_created'),
+            u'metadata_modified': pkg_dict.get(u'metadata_modified'),
+            u'tags': [t[u'name'] for t in pkg_dict.get(u'tags', [])],
+            u'groups': [g[u'name'] for g in pkg_dict.get(u'groups', [])],
+            u'res_format': [r.get(u'format') for r in resources],
+            u'res_name': [r.get(u'name') for r in resources],
+            u'res_description': [r.get(u'description') for r in resources],
+            u'num_resources': len(resources),
+            u'num_tags': len(pkg_dict.get(u'tags', [])),
+            u'validated_data_dict': json.dumps(pkg_dict),
+            u'data_dict': json.dumps(pkg_dict)
+            }
+        for extra in pkg_dict.get(u'extras', []):
+            doc[u'extras_' + extra[u'key']] = extra[u'value']
+        package = model.Package.get(pkg_dict[u'id'])
+        if package is not None:
+            doc[u'permission_labels'] = lib_plugins.get_permission_labels().get_dataset_labels(
+                package)
+        return doc
+
+    def index_package(self, pkg_dict):
+        with self.lock:
+            self.documents[pkg_dict[u'id']] = self.document(pkg_dict)
+
+    def remove(self, pkg_dict):
+        with self.lock:
+            self.documents.pop(pkg_dict[u'id'], None)
+
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+
+    @staticmethod
+    def _field_values(doc, field):
+        value = doc.get(field)
+        if isinstance(value, list):
+            return [u'%s' % v for v in value if v is not None]
+        return [] if value is None else [u'%s' % value]
+
+    def _matches(self, doc, clauses):
+        for required, field, values in clauses:
+            if field is None:
+                text = u' '.join(v for f in self.text_fields for v in
+                                 self._field_values(doc, f)).lower()
+                found = all(v.lower() in text for v in values)
+            else:
+                found = bool(set(values) & set(self._field_values(doc, field)))
+            if found != required:
+                return False
+        return True
+
+    def search(self, query, permission_labels=None):
+        '''
+        Runs a package_search-style query.
+        :param query: the solr query dict (q, fq, fq_list, sort, rows, start, facet.field...)
+        :param permission_labels: the labels the user can see, or None for everything
+        :return: tuple of (results, count, facets)
+        '''
+        fq = query.get(u'fq', u'')
+        clauses = parse(query.get(u'q')) + parse(u' '.join(fq) if isinstance(fq, (list, tuple))
+                                                 else fq)
+        for extra_fq in query.get(u'fq_list', []):
+            clauses += parse(extra_fq)
+        with self.lock:
+            docs = [d for d in self.documents.values() if self._matches(d, clauses)]
+        if permission_labels is not None:
+            labels = set(permission_labels)
+            docs = [d for d in docs if labels & set(d.get(u'permission_labels', []))]
+
+        sort = query.get(u'sort') or u'metadata_modified desc'
+        for part in reversed([s.strip() for s in sort.split(u',') if s.strip()]):
+            bits = part.split()
+            if bits[0] == u'score':
+                continue
+            descending = len(bits) > 1 and bits[1] == u'desc'
+            docs.sort(key=lambda d: (d.get(bits[0]) is None, d.get(bits[0])), reverse=descending)
+
+        facets = {}
+        for field in query.get(u'facet.field', []):
+            counts = {}
+            for doc in docs:
+                for value in self._field_values(doc, field):
+                    counts[value] = counts.get(value, 0) + 1
+            facets[field] = counts
+
+        start = int(query.get(u'start', 0))
+        rows = int(query.get(u'rows', 10))
+        return docs[start:start + rows], len(docs), facets
+
+    @contextmanager
+    def patch(self):
+        '''
+        Replaces the solr package index and query with this index for the duration.
+        '''
+        index = self
+
+        def index_package(self, pkg_dict, defer_commit=False):
+            index.index_package(pkg_dict)
+
+        def remove_dict(self, pkg_dict):
+            index.remove(pkg_dict)
+
+        def clear(self):
+            index.clear()
+
+        def run(self, query, permission_labels=None, **kwargs):
+            # the filters ckan's own run() always adds: only this site's packages and, unless
+            # the query asks for particular states, only active ones
+            query = dict(query)
+            fq_list = list(query.get(u'fq_list', []))
+            fq_list.append(u'+site_id:"{0}"'.format(toolkit.config.get(u'ckan.site_id')))
+            if u'+state:' not in query.get(u'fq', u''):
+                fq_list.append(u'+state:active')
+            query[u'fq_list'] = fq_list
+            self.results, self.count, self.facets = index.search(query, permission_labels)
+            return {
+                u'results': self.results,
+                u'count': self.count
+                }
+
+        patches = [
+            mock.patch(u'ckan.lib.search.index.PackageSearchIndex.index_package', index_package),
+            mock.patch(u'ckan.lib.search.index.PackageSearchIndex.remove_dict', remove_dict),
+            mock.patch(u'ckan.lib.search.index.PackageSearchIndex.delete_package', remove_dict),
+            mock.patch(u'ckan.lib.search.index.PackageSearchIndex.clear', clear),
+            mock.patch(u'ckan.lib.search.index.PackageSearchIndex.commit', lambda self: None),
+            mock.patch(u'ckan.lib.search.query.PackageSearchQuery.run', run),
+            mock.patch(u'ckan.lib.search.commit', lambda: None)
+            ]
+        for p in patches:
+            p.start()
+        try:
+            yield self
+        finally:
+            for p in reversed(patches):
+                p.stop()
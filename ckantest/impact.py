@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import inspect
+import json
+import os
+import subprocess
+import sys
+import threading
+from contextlib import contextmanager
+
+default_path = u'.ckantest-impact.json'
+# what's recorded for each test
+kinds = (u'files', u'actions', u'plugins')
+
+
+def _git(root, *args):
+    return subprocess.check_output((u'git',) + args, cwd=root).decode(u'utf-8')
+
+
+class ImpactRecorder(object):
+    '''
+    Records, for each test, the project files it executed, the actions it looked up through
+    get_action and the plugins it loaded, so that later runs can select only the tests
+    affected by a change. Setup that's shared between tests (module and class fixtures, cached
+    apps) is recorded separately and attributed to every test that uses it, not just the one
+    it happened to run with.
+    '''
+
+    def __init__(self, root=None):
+        '''
+        :param root: the project root; only files under it are recorded
+        '''
+        self.root = os.path.abspath(root or os.getcwd())
+        self.tests = {}
+        self.shared = {}
+        # action/plugin name -> the project file defining it
+        self.sources = dict((kind, {}) for kind in kinds[1:])
+        self.current = None
+        self._stack = []
+        self._seen_codes = {}
+        self._patched = []
+
+    def _relative(self, filename):
+        '''
+        :return: the path relative to the root, or None if the file isn't under it
+        '''
+        if filename.startswith(u'<'):
+            # e.g. <string> and <frozen ...> modules, which aren't real files
+            return None
+        path = os.path.abspath(filename)
+        if not path.startswith(self.root + os.sep):
+            return None
+        return os.path.relpath(path, self.root)
+
+    def _source(self, obj):
+        '''
+        Finds the project file that defines a function or class, looking inside the closures
+        of wrappers (ckan wraps every action function, for example).
+        :return: the path relative to the root, or None if it isn't defined in the project
+        '''
+        pending = [obj]
+        seen = set()
+        while pending:
+            obj = pending.pop(0)
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            try:
+                filename = inspect.getsourcefile(obj)
+            except TypeError:
+                continue
+            path = self._relative(filename) if filename else None
+            if path is not None:
+                return path
+            if getattr(obj, u'__wrapped__', None) is not None:
+                pending.append(obj.__wrapped__)
+            for cell in getattr(obj, u'__closure__', None) or []:
+                try:
+                    contents = cell.cell_contents
+                except ValueError:
+                    continue
+                if inspect.isfunction(contents) or inspect.isclass(contents):
+                    pending.append(contents)
+        return None
+
+    def _profile(self, frame, event, arg):
+        if event != u'call' or self.current is None:
+            return
+        code = frame.f_code
+        # caching by code object keeps this cheap for functions that are called repeatedly
+        path = self._seen_codes.get(code, False)
+        if path is False:
+            path = self._seen_codes[code] = self._relative(code.co_filename)
+        if path is not None:
+            self.current[u'files'].add(path)
+
+    def _record(self, kind, value, obj=None):
+        if self.current is not None:
+            self.current[kind].add(value)
+        if obj is not None and value not in self.sources[kind]:
+            self.sources[kind][value] = self._source(obj)
+
+    def install(self):
+        '''
+        Starts tracing calls and hooks get_action, Configurer.load_plugins and AppCache.load.
+        '''
+        from ckan import logic, plugins
+        from ckan.plugins import toolkit
+        from ckantest.helpers.config import Configurer
+        from ckantest.models.testbase import AppCache, config_key
+
+        recorder = self
+        original_get_action = logic.get_action
+        original_load_plugins = Configurer.load_plugins
+        original_load_app = AppCache.load
+
+        def get_action(action):
+            action_function = original_get_action(action)
+            recorder._record(u'actions', action, action_function)
+            return action_function
+
+        def load_plugins(configurer, *plugin_names):
+            result = original_load_plugins(configurer, *plugin_names)
+            for name in plugin_names:
+                recorder._record(u'plugins', name, type(plugins.get_plugin(name)))
+            return result
+
+        def load_app(cls, plugin_names, persist, reuse=True):
+            if not reuse:
+                return original_load_app(plugin_names, persist, reuse)
+            # the app and plugins are only set up for the first class or module with this
+            # key, so record that setup separately and attribute it to every later user too
+            app_key = config_key(plugin_names, persist)
+            key = u'app {0!r}'.format(app_key)
+            recorder.use(key)
+            if cls.get(app_key)[0] is not None:
+                return original_load_app(plugin_names, persist, reuse)
+            with recorder.recording(key):
+                return original_load_app(plugin_names, persist, reuse)
+
+        for owner, name, replacement in [(logic, u'get_action', get_action),
+                                         (toolkit, u'get_action', get_action),
+                                         (Configurer, u'load_plugins', load_plugins),
+                                         (AppCache, u'load', classmethod(load_app))]:
+            self._patched.append((owner, name, owner.__dict__[name]))
+            setattr(owner, name, replacement)
+        sys.setprofile(self._profile)
+        threading.setprofile(self._profile)
+
+    def uninstall(self):
+        sys.setprofile(None)
+        threading.setprofile(None)
+        for owner, name, original in reversed(self._patched):
+            setattr(owner, name, original)
+        self._patched = []
+
+    @staticmethod
+    def _entry():
+        entry = dict((kind, set()) for kind in kinds)
+        entry[u'uses'] = set()
+        return entry
+
+    def start(self, test_id, uses=None):
+        '''
+        Starts recording a test.
+        :param test_id: the test's id
+        :param uses: keys of the shared setup the test uses (see recording())
+        '''
+        self.current = self.tests[test_id] = self._entry()
+        self.current[u'uses'].update(uses or [])
+        self._stack = []
+
+    def stop(self):
+        self.current = None
+
+    def use(self, key):
+        '''
+        Marks the current test (or shared setup) as using the shared setup recorded under key.
+        '''
+        if self.current is not None:
+            self.current[u'uses'].add(key)
+
+    @contextmanager
+    def recording(self, key):
+        '''
+        Records into a separate entry for shared setup (e.g. a module fixture) while in the
+        block. Tests that use it are attributed everything it recorded when the map is saved.
+        :param key: identifies the shared setup
+        '''
+        self._stack.append(self.current)
+        self.current = self.shared[key] = self._entry()
+        try:
+            yield
+        finally:
+            self.current = self._stack.pop()
+
+    def _resolved(self):
+        '''
+        :return: dict of test id -> the test's entry combined with the shared setup it used
+        '''
+        resolved = {}
+        for test_id, entry in self.tests.items():
+            combined = dict((kind, set(entry[kind])) for kind in kinds)
+            pending = list(entry[u'uses'])
+            seen = set()
+            while pending:
+                key = pending.pop()
+                if key in seen or key not in self.shared:
+                    continue
+                seen.add(key)
+                for kind in kinds:
+                    combined[kind] |= self.shared[key][kind]
+                pending.extend(self.shared[key][u'uses'])
+            resolved[test_id] = combined
+        return resolved
+
+    def save(self, path=default_path, partials=None):
+        '''
+        Writes the map to disk, replacing the entries for any tests recorded this run.
+        :param path: the map file
+        :param partials: paths of maps recorded by other processes in this run (e.g.
+                         pytest-xdist workers) to merge in; they're deleted afterwards
+        '''
+        impact_map = ImpactMap.load(path) if os.path.exists(path) else ImpactMap()
+        impact_map.revision = _git(self.root, u'rev-parse', u'HEAD').strip()
+        impact_map.update(ImpactMap(tests=dict(
+            (test_id, dict((kind, sorted(v)) for kind, v in entry.items())) for test_id, entry
+            in self._resolved().items()), sources=self.sources))
+        for partial in partials or []:
+            impact_map.update(ImpactMap.load(partial))
+        impact_map.save(path)
+        for partial in partials or []:
+            os.remove(partial)
+
+
+class ImpactMap(object):
+    '''
+    The stored map of test id -> files, actions and plugins, plus the project files defining
+    those actions and plugins and the git revision the map was recorded at.
+    '''
+
+    def __init__(self, revision=None, tests=None, sources=None):
+        self.revision = revision
+        self.tests = tests or {}
+        self.sources = sources or {}
+
+    @classmethod
+    def load(cls, path=default_path):
+        with open(path, u'r') as f:
+            data = json.load(f)
+        return cls(data.get(u'revision'), data.get(u'tests', {}), data.get(u'sources', {}))
+
+    def save(self, path=default_path):
+        with open(path, u'w') as f:
+            json.dump({
+                u'revision': self.revision,
+                u'tests': self.tests,
+                u'sources': self.sources
+                }, f, indent=1, sort_keys=True)
+
+    def update(self, other):
+        '''
+        Replaces this map's entries with the tests and sources recorded in another.
+        '''
+        self.tests.update(other.tests)
+        for kind, names in other.sources.items():
+            self.sources.setdefault(kind, {}).update(names)
+
+    @property
+    def files(self):
+        files = set(f for entry in self.tests.values() for f in entry.get(u'files', []))
+        files.update(p for names in self.sources.values() for p in names.values() if p)
+        return files
+
+    def changes(self, root, since):
+        '''
+        Lists the files changed since a revision and checks whether the map can be trusted for
+        them. Files changed since the map itself was recorded are included, as the map doesn't
+        reflect them.
+        :param root: the project root
+        :param since: the git revision to compare against
+        :return: tuple of (set of changed paths relative to the root, a string explaining why
+                 the map is stale or None if it isn't)
+        '''
+        changed = changed_files(root, since)
+        if not self.revision:
+            return changed, u'the map has no revision'
+        try:
+            subprocess.check_call([u'git', u'merge-base', u'--is-ancestor', self.revision,
+                                   u'HEAD'], cwd=root)
+        except subprocess.CalledProcessError:
+            return changed, u'the map was recorded at {0}, which is not an ancestor of ' \
+                            u'HEAD'.format(self.revision[:10])
+        changed |= changed_files(root, self.revision)
+        return changed, self.stale_reason(changed)
+
+    def stale_reason(self, changed):
+        '''
+        Checks whether the map can be trusted for the given changes.
+        :param changed: the set of changed file paths (relative to the root)
+        :return: a string explaining why the map is stale, or None if it isn't
+        '''
+        known = self.files
+        for path in changed:
+            name = os.path.basename(path)
+            if name in (u'setup.py', u'setup.cfg', u'requirements.txt', u'test.ini',
+                        u'pytest.ini', u'tox.ini', u'conftest.py'):
+                return u'{0} changed'.format(path)
+            if path in known:
+                continue
+            if not path.endswith(u'.py'):
+                # templates, fixtures, migrations, etc. aren't traced, so any test might use them
+                return u'{0} is not tracked by the map'.format(path)
+            if not name.startswith(u'test'):
+                return u'{0} has no recorded tests'.format(path)
+        return None
+
+    def affected(self, test_id, test_file, changed):
+        '''
+        :return: True if the test should run for the given changed files
+        '''
+        entry = self.tests.get(test_id)
+        if entry is None or test_file in changed:
+            return True
+        if changed.intersection(entry.get(u'files', [])):
+            return True
+        # plugin and action modules may only have run for an earlier test (e.g. when the
+        # plugins were loaded), so check the files defining the ones this test used as well
+        for kind in kinds[1:]:
+            sources = self.sources.get(kind, {})
+            if any(sources.get(name) in changed for name in entry.get(kind, [])):
+                return True
+        return False
+
+
+def changed_files(root, revision):
+    '''
+    Lists the files that differ from the revision, including uncommitted and untracked ones.
+    :return: set of paths relative to the root
+    '''
+    changed = set(_git(root, u'diff', u'--name-only', revision).splitlines())
+    changed.update(_git(root, u'ls-files', u'--others', u'--exclude-standard').splitlines())
+    top = _git(root, u'rev-parse', u'--show-toplevel').strip()
+    # git gives paths relative to the repository root, which may be above the project root
+    return set(os.path.relpath(os.path.join(top, p), root) for p in changed if p)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import argparse
+import subprocess
+import sys
+
+default_modules = [u'ckantest', u'ckantest.helpers', u'ckantest.factories', u'ckantest.models',
+                   u'ckantest.helpers.mocking', u'ckantest.helpers.config',
+                   u'ckantest.models.testbase']
+
+# imported (if they're installed) before the timer starts, so that only ckantest's own import
+# time is measured rather than ckan's
+default_preload = [u'ckan', u'ckan.plugins', u'ckan.plugins.toolkit', u'ckan.model',
+                   u'ckan.tests.helpers']
+
+_script = u'''
+import timeit
+for name in {1!r}:
+    try:
+        __import__(name)
+    except ImportError:
+        pass
+start = timeit.default_timer()
+import {0}
+print(timeit.default_timer() - start)
+'''
+
+
+def measure(module, repeat=5, preload=None):
+    '''
+    Times importing a module in a fresh interpreter.
+    :param module: the module name
+    :param repeat: the number of interpreters to start; the fastest time is used
+    :param preload: modules to import before starting the timer; defaults to default_preload
+    :return: the import time in seconds
+    '''
+    preload = default_preload if preload is None else preload
+    times = []
+    for _ in range(repeat):
+        script = _script.format(module, [str(m) for m in preload])
+        output = subprocess.check_output([sys.executable, u'-c', script])
+        times.append(float(output.decode(u'utf-8').strip().splitlines()[-1]))
+    return min(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=u'Check that importing ckantest modules stays within a time budget.')
+    parser.add_argument(u'modules', nargs=u'*', default=default_modules)
+    parser.add_argument(u'--budget', type=float, default=0.05,
+                        help=u'Maximum import time per module in seconds (default 0.05).')
+    parser.add_argument(u'--repeat', type=int, default=5)
+    parser.add_argument(u'--preload', nargs=u'*', default=None,
+                        help=u'Modules to import before timing (default: ckan\'s main modules).')
+    args = parser.parse_args(argv)
+
+    over = 0
+    for module in args.modules:
+        try:
+            seconds = measure(module, args.repeat, args.preload)
+        except subprocess.CalledProcessError:
+            over += 1
+            print(u'          IMPORT FAILED  {0}'.format(module))
+            continue
+        status = u'OK' if seconds <= args.budget else u'OVER BUDGET'
+        over += seconds > args.budget
+        print(u'{0:>8.1f}ms  {1}  {2}'.format(seconds * 1000, status, module))
+    return 1 if over else 0
+
+
+if __name__ == u'__main__':
+    sys.exit(main())
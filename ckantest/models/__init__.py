@@ -4,4 +4,9 @@
 # This file is part of ckantest
 # Created by the Natural History Museum in London, UK
 
-from .testbase import TestBase
\ No newline at end of file
+from ckantest._lazy import lazy
+
+lazy(__name__, globals(), attributes={
+    u'TestBase': u'.testbase',
+    u'BenchmarkBase': u'.benchmark'
+    })
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import timeit
+
+from ckantest.helpers.benchmark import Results
+from .testbase import TestBase
+
+from ckan.plugins import toolkit
+
+
+class BenchmarkBase(TestBase):
+    '''
+    A TestBase for measuring action latency. Call self.benchmark() in tests; the results for
+    the class are written to results_path (if set) in teardown_class.
+    '''
+    results_path = None  # JSON file to write results to, e.g. 'benchmarks.json'
+    repeat = 100  # default number of timed calls per benchmark
+    warmup = 5  # untimed calls made before timing starts
+
+    @classmethod
+    def setup_class(cls):
+        super(BenchmarkBase, cls).setup_class()
+        cls.results = Results()
+
+    @classmethod
+    def teardown_class(cls):
+        if cls.results_path is not None:
+            cls.results.save(cls.results_path)
+        super(BenchmarkBase, cls).teardown_class()
+
+    def benchmark(self, action, params=None, fixture_size=0, repeat=None, name=None,
+                  through_api=False, method=u'get'):
+        '''
+        Calls an action repeatedly and records its latency.
+        :param action: the action name, e.g. package_search
+        :param params: the data_dict/parameters for the action
+        :param fixture_size: make sure at least this many packages exist first
+        :param repeat: the number of timed calls; defaults to cls.repeat
+        :param name: the name to store the result under; defaults to action[fixture_size]
+        :param through_api: make the calls through api_request() (i.e. the full request
+                            stack) instead of calling the action directly
+        :param method: the HTTP method to use with through_api
+        :return: the result summary dict
+        '''
+        df = self.data_factory()
+        missing = fixture_size - len(df.packages.keys())
+        if missing > 0:
+            df.packages_bulk(missing)
+        params = params or {}
+        if through_api:
+            def call():
+                self.api_request(action, params=params, method=method)
+        else:
+            action_function = toolkit.get_action(action)
+
+            def call():
+                action_function(df.context, dict(params))
+
+        for _ in range(self.warmup):
+            call()
+        timer = timeit.default_timer
+        timings = []
+        started = timer()
+        for _ in range(repeat or self.repeat):
+            start = timer()
+            call()
+            timings.append(timer() - start)
+        total = timer() - started
+        return self.results.add(name or u'{0}[{1}]'.format(action, fixture_size), timings,
+                                total, action=action, fixture_size=fixture_size)
@@ -6,41 +6,176 @@
 
 import ckantest.factories
 import ckantest.helpers
+import ckantest.helpers.database
+import ckantest.helpers.memory
+import ckantest.helpers.mocking
 
 from ckan.tests import helpers
 from unittest import TestCase
 
 
+def config_key(plugins, persist):
+    '''
+    Identifies a plugin set and persistent config; test classes (or modules) with the same key
+    can share the same loaded plugins and app.
+    :return: tuple
+    '''
+    return tuple(plugins), tuple(sorted((k, repr(v)) for k, v in persist.items()))
+
+
+class AppCache(object):
+    '''
+    Holds the configurer (and therefore the loaded plugins) and app from the most recent test
+    class so the next class can reuse them if it has the same config key. Users (classes and
+    modules) are counted, so if a class with other plugins runs while the cached app is still
+    in use (e.g. by a module's fixtures), the cached plugins are unloaded while it runs and
+    loaded again when it's done rather than released for good.
+    '''
+    key = None
+    config = None
+    app = None
+    users = 0
+    # (key, config, app, users) of caches that made way for other plugins while in use
+    _suspended = []
+
+    @classmethod
+    def get(cls, key):
+        '''
+        Returns the cached configurer and app if they were created for the given key.
+        :return: tuple of (Configurer, app), or (None, None)
+        '''
+        if cls.config is not None and cls.key == key:
+            return cls.config, cls.app
+        return None, None
+
+    @classmethod
+    def set(cls, key, config, app, users=0):
+        cls.key = key
+        cls.config = config
+        cls.app = app
+        cls.users = users
+
+    @classmethod
+    def load(cls, plugins, persist, reuse=True):
+        '''
+        Returns a configurer with the given plugins loaded and an app, reusing the cached
+        ones (after a soft reset) if they have the same key. Call done() with the configurer
+        when finished with it.
+        :param plugins: a list of plugin names to load
+        :param persist: config settings to maintain when resetting
+        :param reuse: use and update the cache; if False, new configurer and app are created
+                      and not cached
+        :return: tuple of (Configurer, app)
+        '''
+        key = config_key(plugins, persist)
+        config, app = cls.get(key) if reuse else (None, None)
+        if config is not None:
+            cls.users += 1
+            config.soft_reset()
+            return config, app
+        if cls.config is not None:
+            if cls.users:
+                # still in use, so unload the plugins for now and put them back in done()
+                cls.config.reset()
+                cls._suspended.append((cls.key, cls.config, cls.app, cls.users))
+                cls.set(None, None, None)
+            else:
+                cls.release()
+        config = ckantest.helpers.Configurer(persist)
+        config.load_plugins(*plugins)
+        app = helpers._get_test_app()
+        config.register_blueprints(app)
+        if reuse:
+            cls.set(key, config, app, users=1)
+        return config, app
+
+    @classmethod
+    def done(cls, config):
+        '''
+        Called when a class or module has finished with a configurer from load(). Cached
+        plugins stay loaded in case the next user can reuse them; anything else is released.
+        If the plugins of a cache that's still in use were unloaded to make way, they're
+        loaded again once nothing is using the current ones.
+        :param config: the Configurer
+        '''
+        if config is cls.config:
+            cls.users -= 1
+            config.soft_reset()
+        else:
+            config.release()
+        if cls._suspended and not cls.users:
+            if cls.config is not None:
+                cls.config.release()
+            key, config, app, users = cls._suspended.pop()
+            config.reload_plugins()
+            cls.set(key, config, app, users)
+
+    @classmethod
+    def release(cls):
+        '''
+        Resets the cached config (unloading its plugins) and forgets the app, along with any
+        suspended caches.
+        '''
+        if cls.config is not None:
+            cls.config.release()
+        while cls._suspended:
+            # their plugins were already unloaded
+            cls._suspended.pop()[1].release(reset=False)
+        cls.set(None, None, None)
+
+
 class TestBase(TestCase):
     '''
 
     '''
     plugins = []  # a list of plugin names to load
     persist = {}  # config settings to maintain when resetting, e.g. {'myextension.debug': True}
+    snapshot = False  # restore a snapshot of the base fixtures instead of rebuilding the db
+    # share plugins and app with the previous class if the config key matches; the plugins
+    # stay loaded after the class finishes until a class with a different key (or that doesn't
+    # reuse) is set up or, under pytest, the session ends
+    reuse_app = False
+
+    @classmethod
+    def config_key(cls):
+        '''
+        Identifies the plugin set and persistent config for this class; consecutive classes
+        with the same key can share the same loaded plugins and app.
+        :return: tuple
+        '''
+        return config_key(cls.plugins, cls.persist)
 
     @classmethod
     def setup_class(cls):
-        cls.config = ckantest.helpers.Configurer(cls.persist)
-        cls.config.load_plugins(*cls.plugins)
-        cls.app = helpers._get_test_app()
-        cls.config.register_blueprints(cls.app)
+        tracker = ckantest.helpers.memory.tracker
+        if tracker is not None:
+            tracker.class_started(cls.__name__)
+        cls.config, cls.app = AppCache.load(cls.plugins, cls.persist, cls.reuse_app)
         cls.context = cls.app.flask_app.test_request_context()
         cls._session = ckantest.helpers.mocking.session()
         cls._df = None
 
     @classmethod
     def teardown_class(cls):
-        cls.config.reset()
+        # the plugins stay loaded in case the next class can use them (if they're cached)
+        AppCache.done(cls.config)
         if cls._df is None:
-            helpers.reset_db()
+            ckantest.helpers.database.reset(cls.snapshot)
         else:
             cls.data_factory().destroy()
+        # don't keep this class's data and request context alive for the rest of the run
+        cls._df = None
+        cls.context = None
+        cls._session = None
+        tracker = ckantest.helpers.memory.tracker
+        if tracker is not None:
+            tracker.class_finished(cls.__name__)
 
     @classmethod
     def data_factory(cls):
         if cls._df is None:
             with cls.context:
-                cls._df = ckantest.factories.DataFactory()
+                cls._df = ckantest.factories.DataFactory(snapshot=cls.snapshot)
         return cls._df
 
     def api_request(self, action, params=None, method='get'):
@@ -0,0 +1,643 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import json
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from ckan import plugins
+from ckan.plugins import toolkit
+
+_strings = (str, type(u''))
+
+# the column types that values are converted to (as postgres would) when they're written or
+# used in filters; anything else is stored as it is
+_int_types = {u'int', u'integer', u'int4', u'int8', u'bigint', u'smallint'}
+_float_types = {u'float', u'float4', u'float8', u'numeric', u'double precision', u'real'}
+_bool_types = {u'bool', u'boolean'}
+_text_types = {u'text', u'varchar', u'char'}
+
+
+def _field_type(value):
+    if isinstance(value, bool):
+        return u'bool'
+    if isinstance(value, int):
+        return u'int'
+    if isinstance(value, float):
+        return u'float'
+    return u'text'
+
+
+def _coerce(field_type, value):
+    '''
+    Converts a value to a column's type.
+    :raises ValueError: if it can't be converted
+    '''
+    if value is None:
+        return None
+    if field_type in _int_types:
+        if isinstance(value, float) and not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    if field_type in _float_types:
+        return float(value)
+    if field_type in _bool_types:
+        if isinstance(value, _strings):
+            lowered = value.lower()
+            if lowered in (u'true', u't', u'yes', u'1'):
+                return True
+            if lowered in (u'false', u'f', u'no', u'0'):
+                return False
+            raise ValueError(value)
+        return bool(value)
+    if field_type in _text_types and isinstance(value, (int, float)):
+        return u'{0}'.format(value)
+    return value
+
+
+class Table(object):
+    '''
+    The records for one resource, stored as a list of values per field. Indexes mapping
+    values to row numbers are built for a field the first time it's filtered on and kept up
+    to date as rows are inserted and updated (deleting rows renumbers them, so it drops the
+    indexes).
+    '''
+
+    def __init__(self, fields=None, primary_key=None):
+        self.fields = []
+        self.columns = {}
+        self.size = 0
+        self.ids = []
+        self._next_id = 1
+        self.primary_key = primary_key or []
+        self._indexes = {}
+        self.add_fields(fields or [])
+
+    def add_fields(self, fields):
+        for field in fields:
+            if field[u'id'] not in self.columns:
+                self.fields.append({
+                    u'id': field[u'id'],
+                    u'type': field.get(u'type', u'text')
+                    })
+                self.columns[field[u'id']] = [None] * self.size
+
+    def _add_fields_from(self, records):
+        new = []
+        for record in records:
+            for key, value in record.items():
+                if key not in self.columns and key not in [f[u'id'] for f in new]:
+                    new.append({
+                        u'id': key,
+                        u'type': _field_type(value)
+                        })
+        self.add_fields(new)
+
+    def field_type(self, field):
+        for f in self.fields:
+            if f[u'id'] == field:
+                return f[u'type']
+        return None
+
+    def coerce(self, records):
+        '''
+        Converts the values in the records to their columns' types.
+        :return: list of new records
+        '''
+        types = dict((f[u'id'], f[u'type']) for f in self.fields)
+        coerced = []
+        for record in records:
+            if not isinstance(record, dict):
+                raise toolkit.ValidationError({
+                    u'records': [u'Records must be dicts.']
+                    })
+            try:
+                coerced.append(dict((k, _coerce(types.get(k), v)) for k, v in record.items()))
+            except (TypeError, ValueError) as e:
+                raise toolkit.ValidationError({
+                    u'records': [u'Invalid value: {0}'.format(e)]
+                    })
+        return coerced
+
+    def index(self, field):
+        '''
+        :return: dict of value -> set of row numbers for the field
+        '''
+        if field not in self._indexes:
+            index = defaultdict(set)
+            column = self.ids if field == u'_id' else self.columns[field]
+            for row, value in enumerate(column):
+                index[value].add(row)
+            self._indexes[field] = index
+        return self._indexes[field]
+
+    def insert(self, records):
+        self._add_fields_from(records)
+        records = self.coerce(records)
+        for name, column in self.columns.items():
+            column.extend(r.get(name) for r in records)
+        ids = list(range(self._next_id, self._next_id + len(records)))
+        for name, index in self._indexes.items():
+            values = ids if name == u'_id' else [r.get(name) for r in records]
+            for row, value in enumerate(values, self.size):
+                index[value].add(row)
+        self.ids.extend(ids)
+        self._next_id += len(records)
+        self.size += len(records)
+
+    def set(self, row, name, value):
+        '''
+        Changes one value, updating the field's index if it has one.
+        '''
+        column = self.columns[name]
+        index = self._indexes.get(name)
+        if index is not None:
+            rows = index.get(column[row])
+            if rows is not None:
+                rows.discard(row)
+                if not rows:
+                    del index[column[row]]
+            index[value].add(row)
+        column[row] = value
+
+    def find(self, filters):
+        '''
+        Finds rows matching all the filters (field -> value or list of values, including
+        _id) using the field indexes.
+        :return: sorted list of row numbers
+        '''
+        rows = None
+        for field, values in filters.items():
+            if field != u'_id' and field not in self.columns:
+                return []
+            index = self.index(field)
+            if not isinstance(values, list):
+                values = [values]
+            matches = set()
+            for value in values:
+                matches.update(index.get(value, []))
+            rows = matches if rows is None else rows & matches
+            if not rows:
+                return []
+        return sorted(rows) if rows is not None else list(range(self.size))
+
+    def upsert(self, records, method=u'upsert'):
+        if method == u'insert' or not self.primary_key:
+            if method != u'insert':
+                raise toolkit.ValidationError({
+                    u'records': [u'A primary key is needed to {0} records.'.format(method)]
+                    })
+            self.insert(records)
+            return
+        self._add_fields_from(records)
+        new = []
+        # new records by key, so later records with the same key update them
+        pending = {}
+        for record in self.coerce(records):
+            key = tuple(record.get(k) for k in self.primary_key)
+            rows = self.find(dict(zip(self.primary_key, key)))
+            if rows:
+                for name, value in record.items():
+                    self.set(rows[0], name, value)
+            elif key in pending:
+                pending[key].update(record)
+            elif method == u'update':
+                raise toolkit.ObjectNotFound(u'No record with key {0}'.format(
+                    dict(zip(self.primary_key, key))))
+            else:
+                pending[key] = record
+                new.append(record)
+        if new:
+            self.insert(new)
+
+    def delete(self, rows):
+        keep = sorted(set(range(self.size)) - set(rows))
+        for name in self.columns:
+            column = self.columns[name]
+            self.columns[name] = [column[i] for i in keep]
+        self.ids = [self.ids[i] for i in keep]
+        self.size = len(keep)
+        self._indexes = {}
+
+    def copy(self):
+        '''
+        :return: a copy of the table that can be changed independently (without the indexes,
+                 which are rebuilt when they're next needed)
+        '''
+        table = Table(primary_key=list(self.primary_key))
+        table.fields = [dict(f) for f in self.fields]
+        table.columns = dict((name, list(column)) for name, column in self.columns.items())
+        table.size = self.size
+        table.ids = list(self.ids)
+        table._next_id = self._next_id
+        return table
+
+    def record(self, row, fields):
+        record = {
+            u'_id': self.ids[row]
+            }
+        for name in fields:
+            record[name] = self.columns[name][row]
+        return record
+
+
+class MemoryStore(object):
+    '''
+    Holds a Table for each resource.
+    '''
+
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.RLock()
+        # resource id -> the table before it was first changed (None if it didn't exist)
+        # inside a checkpoint()
+        self._saved = None
+
+    def clear(self):
+        with self.lock:
+            for resource_id in list(self.tables):
+                self.changing(resource_id)
+            self.tables.clear()
+
+    def changing(self, resource_id):
+        '''
+        Called (with the lock held) before a resource's table is created, changed or dropped.
+        '''
+        if self._saved is not None and resource_id not in self._saved:
+            table = self.tables.get(resource_id)
+            self._saved[resource_id] = None if table is None else table.copy()
+
+    @contextmanager
+    def checkpoint(self):
+        '''
+        A context manager that puts the tables back the way they were when it exits. Tables
+        are only copied the first time they're changed inside it.
+        '''
+        with self.lock:
+            previous, self._saved = self._saved, {}
+        try:
+            yield
+        finally:
+            with self.lock:
+                for resource_id, table in self._saved.items():
+                    if table is None:
+                        self.tables.pop(resource_id, None)
+                    else:
+                        self.tables[resource_id] = table
+                self._saved = previous
+
+    def get(self, resource_id):
+        table = self.tables.get(resource_id)
+        if table is None:
+            raise toolkit.ObjectNotFound(u'Resource "{0}" was not found.'.format(resource_id))
+        return table
+
+
+store = MemoryStore()
+
+
+def _set_active(context, resource_id, active):
+    toolkit.get_action(u'resource_patch')({
+        u'user': context.get(u'user'),
+        u'ignore_auth': True
+        }, {
+        u'id': resource_id,
+        u'datastore_active': active
+        })
+
+
+def _invalid(key, message):
+    return toolkit.ValidationError({
+        key: [message]
+        })
+
+
+def _resource_id(data_dict):
+    resource_id = data_dict.get(u'resource_id')
+    if not resource_id:
+        raise _invalid(u'resource_id', u'Missing value')
+    return resource_id
+
+
+def _json(data_dict, key, types):
+    '''
+    Returns a parameter that may have been sent as a JSON string (e.g. in a GET request),
+    checking that it's one of the given types.
+    '''
+    value = data_dict.get(key)
+    if isinstance(value, _strings) and value.strip()[:1] in (u'{', u'['):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise _invalid(key, u'Cannot parse JSON')
+    if value is not None and not isinstance(value, types):
+        raise _invalid(key, u'Invalid value')
+    return value
+
+
+def _names(data_dict, key):
+    '''
+    Returns a parameter that can be a list of strings, a JSON list or a comma-separated string.
+    '''
+    value = _json(data_dict, key, _strings + (list,))
+    if value is None:
+        return []
+    if isinstance(value, _strings):
+        value = value.split(u',')
+    if not all(isinstance(v, _strings) for v in value):
+        raise _invalid(key, u'Must be a list of strings')
+    return [v.strip() for v in value if v.strip()]
+
+
+def _int(data_dict, key, default):
+    try:
+        value = int(data_dict.get(key, default))
+    except (TypeError, ValueError):
+        raise _invalid(key, u'Must be an integer')
+    if value < 0:
+        raise _invalid(key, u'Must be a positive integer')
+    return value
+
+
+def _check_fields(table, key, names):
+    for name in names:
+        if name != u'_id' and name not in table.columns:
+            raise _invalid(key, u'field "{0}" not in resource'.format(name))
+
+
+def _filters(table, data_dict):
+    '''
+    Parses the filters and converts their values to the fields' types.
+    '''
+    filters = _json(data_dict, u'filters', dict) or {}
+    _check_fields(table, u'filters', filters.keys())
+    coerced = {}
+    for field, values in filters.items():
+        field_type = u'int' if field == u'_id' else table.field_type(field)
+        try:
+            if isinstance(values, list):
+                coerced[field] = [_coerce(field_type, v) for v in values]
+            else:
+                coerced[field] = _coerce(field_type, values)
+        except (TypeError, ValueError):
+            raise _invalid(u'filters', u'Invalid value for field "{0}"'.format(field))
+    return coerced
+
+
+def _records(data_dict):
+    records = _json(data_dict, u'records', list) or []
+    if not all(isinstance(r, dict) for r in records):
+        raise _invalid(u'records', u'Records must be dicts.')
+    return records
+
+
+def _public_fields(table):
+    return [{
+        u'id': u'_id',
+        u'type': u'int'
+        }] + [dict(f) for f in table.fields]
+
+
+def datastore_create(context, data_dict):
+    toolkit.check_access(u'datastore_create', context, data_dict)
+    resource_id = _resource_id(data_dict)
+    primary_key = _names(data_dict, u'primary_key')
+    fields = _json(data_dict, u'fields', list) or []
+    if not all(isinstance(f, dict) and f.get(u'id') for f in fields):
+        raise _invalid(u'fields', u'Fields must be dicts with an id.')
+    records = _records(data_dict)
+    with store.lock:
+        store.changing(resource_id)
+        table = store.tables.get(resource_id)
+        if table is None:
+            table = store.tables[resource_id] = Table(fields, primary_key)
+        else:
+            table.add_fields(fields)
+        if records:
+            table.upsert(records, u'insert')
+    _set_active(context, resource_id, True)
+    return {
+        u'resource_id': resource_id,
+        u'fields': _public_fields(table),
+        u'primary_key': primary_key
+        }
+
+
+def datastore_upsert(context, data_dict):
+    toolkit.check_access(u'datastore_upsert', context, data_dict)
+    resource_id = _resource_id(data_dict)
+    records = _records(data_dict)
+    replace = toolkit.asbool(data_dict.get(u'replace', False))
+    method = data_dict.get(u'method', u'insert' if replace else u'upsert')
+    if method not in (u'insert', u'update', u'upsert'):
+        raise _invalid(u'method', u'Must be insert, update or upsert')
+    with store.lock:
+        table = store.get(resource_id)
+        store.changing(resource_id)
+        if replace:
+            # the versioned datastore's way of replacing every record
+            table.delete(range(table.size))
+        table.upsert(records, method)
+    return {
+        u'resource_id': resource_id
+        }
+
+
+def datastore_delete(context, data_dict):
+    toolkit.check_access(u'datastore_delete', context, data_dict)
+    resource_id = _resource_id(data_dict)
+    with store.lock:
+        table = store.get(resource_id)
+        filters = _filters(table, data_dict)
+        store.changing(resource_id)
+        # as in the real datastore, leaving filters out drops the table, while empty filters
+        # delete every record but keep it
+        drop = u'filters' not in data_dict
+        if drop:
+            del store.tables[resource_id]
+        else:
+            table.delete(table.find(filters))
+    if drop:
+        _set_active(context, resource_id, False)
+    return {
+        u'resource_id': resource_id,
+        u'filters': filters
+        }
+
+
+def _matches_q(table, q, rows):
+    '''
+    Filters rows by a full text query (matching any text field) or a dict of field -> text,
+    using case-insensitive substring matches.
+    '''
+    if isinstance(q, dict):
+        terms = [(field, u'{0}'.format(text).lower()) for field, text in q.items()]
+    else:
+        terms = [(None, q.lower())]
+    text_fields = [f[u'id'] for f in table.fields if f[u'type'] == u'text']
+    matched = []
+    for row in rows:
+        for field, text in terms:
+            candidates = [field] if field else text_fields
+            if not any(text in (u'%s' % table.columns[c][row]).lower() for c in candidates
+                       if table.columns[c][row] is not None):
+                break
+        else:
+            matched.append(row)
+    return matched
+
+
+def _parse_sort(table, sort):
+    '''
+    :return: list of (field, descending) tuples
+    '''
+    parsed = []
+    for part in sort:
+        bits = part.split()
+        if len(bits) > 2 or (len(bits) == 2 and bits[1].lower() not in (u'asc', u'desc')):
+            raise _invalid(u'sort', u'Cannot parse "{0}"'.format(part))
+        parsed.append((bits[0].strip(u'"'), len(bits) == 2 and bits[1].lower() == u'desc'))
+    _check_fields(table, u'sort', [field for field, _ in parsed])
+    return parsed
+
+
+def _sort(table, rows, sort):
+    # apply the sort keys in reverse so that earlier keys take priority
+    for field, descending in reversed(sort):
+        if field == u'_id':
+            # rows are kept in _id order
+            rows.sort(reverse=descending)
+            continue
+        column = table.columns[field]
+        # None sorts last regardless of direction
+        rows.sort(key=lambda r: (column[r] is None, column[r]) if not descending else
+                  (column[r] is not None, column[r]), reverse=descending)
+    return rows
+
+
+def datastore_search(context, data_dict):
+    toolkit.check_access(u'datastore_search', context, data_dict)
+    resource_id = _resource_id(data_dict)
+    limit = _int(data_dict, u'limit', 100)
+    offset = _int(data_dict, u'offset', 0)
+    q = _json(data_dict, u'q', _strings + (dict,))
+    with store.lock:
+        table = store.get(resource_id)
+        rows = table.find(_filters(table, data_dict))
+        if isinstance(q, dict):
+            _check_fields(table, u'q', q.keys())
+        if q:
+            rows = _matches_q(table, q, rows)
+        sort = _parse_sort(table, _names(data_dict, u'sort'))
+        if sort:
+            rows = _sort(table, rows, sort)
+        fields = _names(data_dict, u'fields') or [f[u'id'] for f in table.fields]
+        _check_fields(table, u'fields', fields)
+        fields = [f for f in fields if f != u'_id']
+        records = [table.record(r, fields) for r in rows[offset:offset + limit]]
+        field_info = [f for f in _public_fields(table) if f[u'id'] == u'_id' or
+                      f[u'id'] in fields]
+    result = {
+        u'resource_id': resource_id,
+        u'fields': field_info,
+        u'records': records,
+        u'limit': limit,
+        u'offset': offset
+        }
+    if toolkit.asbool(data_dict.get(u'include_total', True)):
+        result[u'total'] = len(rows)
+    return result
+
+
+def datastore_info(context, data_dict):
+    toolkit.check_access(u'datastore_info', context, data_dict)
+    resource_id = data_dict.get(u'id') or _resource_id(data_dict)
+    with store.lock:
+        table = store.get(resource_id)
+        return {
+            u'meta': {
+                u'count': table.size
+                },
+            u'schema': dict((f[u'id'], f[u'type']) for f in table.fields)
+            }
+
+
+# side_effect_free lets the search actions be called through GET requests to the API
+datastore_search.side_effect_free = True
+datastore_info.side_effect_free = True
+
+
+def _auth(privilege, context, data_dict):
+    '''
+    Mirrors the datastore's auth: the user needs the given permission on the resource.
+    '''
+    resource_id = data_dict.get(u'id') or data_dict.get(u'resource_id')
+    try:
+        toolkit.check_access(privilege, context, {
+            u'id': resource_id
+            })
+    except toolkit.NotAuthorized:
+        return {
+            u'success': False,
+            u'msg': u'User {0} not authorized to {1} resource {2}'.format(
+                context.get(u'user'), privilege, resource_id)
+            }
+    return {
+        u'success': True
+        }
+
+
+def datastore_create_auth(context, data_dict):
+    return _auth(u'resource_update', context, data_dict)
+
+
+def datastore_upsert_auth(context, data_dict):
+    return _auth(u'resource_update', context, data_dict)
+
+
+def datastore_delete_auth(context, data_dict):
+    return _auth(u'resource_update', context, data_dict)
+
+
+@toolkit.auth_allow_anonymous_access
+def datastore_search_auth(context, data_dict):
+    return _auth(u'resource_show', context, data_dict)
+
+
+@toolkit.auth_allow_anonymous_access
+def datastore_info_auth(context, data_dict):
+    return _auth(u'resource_show', context, data_dict)
+
+
+class MemoryDatastorePlugin(plugins.SingletonPlugin):
+    '''
+    A lightweight stand-in for the datastore that keeps records in memory. It implements
+    datastore_create, datastore_upsert, datastore_delete, datastore_search and datastore_info
+    with filters, full text queries, sorting and paging (and the same auth checks and
+    parameter validation), but none of the backend-specific behaviour (SQL queries,
+    versioning, etc.) of the real datastore plugins.
+    '''
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+
+    def get_actions(self):
+        return {
+            u'datastore_create': datastore_create,
+            u'datastore_upsert': datastore_upsert,
+            u'datastore_delete': datastore_delete,
+            u'datastore_search': datastore_search,
+            u'datastore_info': datastore_info
+            }
+
+    def get_auth_functions(self):
+        return {
+            u'datastore_create': datastore_create_auth,
+            u'datastore_upsert': datastore_upsert_auth,
+            u'datastore_delete': datastore_delete_auth,
+            u'datastore_search': datastore_search_auth,
+            u'datastore_info': datastore_info_auth
+            }
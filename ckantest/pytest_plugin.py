@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckantest
+# Created by the Natural History Museum in London, UK
+
+import glob
+import os
+from collections import OrderedDict
+
+import pytest
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup(u'ckantest')
+    group.addoption(u'--ckantest-schedule', action=u'store_true', default=False,
+                    help=u'Reorder TestBase classes so that classes with the same plugins and '
+                         u'persistent config run consecutively.')
+    group.addoption(u'--ckantest-profile', action=u'store_true', default=False,
+                    help=u'Time the setup/teardown phases of each test class and print a '
+                         u'ranked report at the end of the run.')
+    group.addoption(u'--ckantest-profile-stacks', type=int, default=0, metavar=u'N',
+                    help=u'Keep cProfile stats for the N slowest phases (implies '
+                         u'--ckantest-profile).')
+    group.addoption(u'--ckantest-profile-folded', default=None, metavar=u'PATH',
+                    help=u'Write the phase timings to PATH in flame graph (folded) format '
+                         u'(implies --ckantest-profile).')
+    group.addoption(u'--ckantest-memory', type=float, default=None, metavar=u'KIB',
+                    help=u'Track memory growth across each TestBase class with tracemalloc and '
+                         u'report classes that grow by more than KIB kibibytes.')
+    group.addoption(u'--ckantest-impact-record', action=u'store_true', default=False,
+                    help=u'Record the files, actions and plugins each test uses in the impact '
+                         u'map.')
+    group.addoption(u'--ckantest-impact-since', default=None, metavar=u'REV',
+                    help=u'Only run tests affected by files changed since the git revision REV, '
+                         u'according to the impact map (runs everything if the map is stale).')
+    group.addoption(u'--ckantest-impact-map', default=u'.ckantest-impact.json', metavar=u'PATH',
+                    help=u'The impact map file (default .ckantest-impact.json).')
+    group.addoption(u'--ckantest-isolate', action=u'store_true', default=False,
+                    help=u'Give each pytest-xdist worker its own database so tests can run '
+                         u'in parallel.')
+
+
+def pytest_configure(config):
+    options = config.option
+    if options.ckantest_impact_record and options.ckantest_profile_stacks:
+        # cProfile replaces (and then clears) the sys.setprofile hook the recorder relies on
+        raise pytest.UsageError(u'--ckantest-impact-record cannot be used with '
+                                u'--ckantest-profile-stacks.')
+    if options.ckantest_profile or options.ckantest_profile_stacks or \
+            options.ckantest_profile_folded:
+        from ckantest.helpers.profiling import FixtureProfiler
+
+        config._ckantest_profiler = FixtureProfiler(options.ckantest_profile_stacks)
+        config._ckantest_profiler.install()
+    if options.ckantest_memory is not None:
+        from ckantest.helpers import memory
+
+        memory.enable(threshold=int(options.ckantest_memory * 1024))
+    if options.ckantest_impact_record:
+        from ckantest.impact import ImpactRecorder
+
+        if not hasattr(config, u'workerinput'):
+            # leftovers from pytest-xdist workers in an interrupted run
+            for partial in _impact_partials(config):
+                os.remove(partial)
+        config._ckantest_impact = ImpactRecorder(str(config.rootdir))
+        config._ckantest_impact.install()
+
+
+def _impact_partials(config):
+    '''
+    :return: the impact maps written by pytest-xdist workers
+    '''
+    return glob.glob(u'{0}.*.part'.format(config.option.ckantest_impact_map))
+
+
+def pytest_unconfigure(config):
+    recorder = getattr(config, u'_ckantest_impact', None)
+    if recorder is not None:
+        recorder.uninstall()
+        path = config.option.ckantest_impact_map
+        workerinput = getattr(config, u'workerinput', None)
+        if workerinput is not None:
+            # each worker writes its own map and the controller merges them when it finishes,
+            # so workers don't overwrite each other's entries
+            recorder.save(u'{0}.{1}.part'.format(path, workerinput[u'workerid']))
+        else:
+            recorder.save(path, _impact_partials(config))
+    profiler = getattr(config, u'_ckantest_profiler', None)
+    if profiler is not None:
+        profiler.uninstall()
+    if config.option.ckantest_memory is not None:
+        from ckantest.helpers import memory
+
+        memory.disable()
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    recorder = getattr(item.config, u'_ckantest_impact', None)
+    if recorder is None:
+        yield
+        return
+    # module and class setup only runs with the first test that uses it, so it's recorded
+    # separately (see pytest_fixture_setup) and attributed to every test using the fixture
+    fixturedefs = getattr(item, u'_fixtureinfo', None)
+    fixturedefs = fixturedefs.name2fixturedefs.values() if fixturedefs is not None else []
+    recorder.start(item.nodeid, [_fixture_key(d) for defs in fixturedefs for d in defs
+                                 if d.scope != u'function'])
+    try:
+        yield
+    finally:
+        recorder.stop()
+
+
+def _fixture_key(fixturedef):
+    return u'fixture {0}::{1}'.format(fixturedef.baseid, fixturedef.argname)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(fixturedef, request):
+    recorder = getattr(request.config, u'_ckantest_impact', None)
+    if recorder is None or fixturedef.scope == u'function':
+        yield
+        return
+    with recorder.recording(_fixture_key(fixturedef)):
+        yield
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_setup(item):
+    profiler = getattr(item.config, u'_ckantest_profiler', None)
+    if profiler is not None:
+        # class setup happens during the first item's setup, so set the name beforehand
+        cls = getattr(item, u'cls', None)
+        profiler.current = cls.__name__ if cls is not None else item.nodeid
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    if config.option.ckantest_memory is not None:
+        from ckantest.helpers import memory
+
+        if memory.tracker is not None:
+            terminalreporter.write_sep(u'=', u'ckantest memory growth by class')
+            terminalreporter.write_line(memory.tracker.report())
+    profiler = getattr(config, u'_ckantest_profiler', None)
+    if profiler is None:
+        return
+    terminalreporter.write_sep(u'=', u'ckantest fixture profile')
+    terminalreporter.write_line(profiler.report())
+    if config.option.ckantest_profile_folded:
+        profiler.write_folded(config.option.ckantest_profile_folded)
+        terminalreporter.write_line(u'Folded stacks written to {0}'.format(
+            config.option.ckantest_profile_folded))
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_sessionstart(session):
+    # trylast so that ckan's own plugin has loaded the config first
+    if not session.config.getoption(u'ckantest_isolate'):
+        return
+    from ckantest.helpers import Configurer, database
+
+    configurer = Configurer()
+    database.isolate_worker(configurer)
+    # the worker's config stays for the whole session
+    configurer.release(reset=False)
+
+
+def _config_key(item):
+    '''
+    Returns the config key of the TestBase subclass the item belongs to, or None if it
+    doesn't belong to one. Classes that don't reuse the app reload their plugins anyway, so
+    they get a key of their own and aren't grouped with anything.
+    '''
+    from ckantest.models.testbase import TestBase
+
+    cls = getattr(item, u'cls', None)
+    if cls is None or not issubclass(cls, TestBase):
+        return None
+    if not cls.reuse_app:
+        return u'{0}.{1}'.format(cls.__module__, cls.__name__)
+    return cls.config_key()
+
+
+def _transitions(keys):
+    '''
+    Counts the number of times the plugin config has to change when running classes with the
+    given keys in order. Items that don't belong to a TestBase class (None) are ignored.
+    '''
+    count = 0
+    previous = None
+    for key in keys:
+        if key is None or key == previous:
+            continue
+        count += 1
+        previous = key
+    return count
+
+
+def schedule(items):
+    '''
+    Reorders test items so that TestBase classes sharing a config key are adjacent, keeping
+    the original order within each group. Everything else runs first, in its original order.
+    :param items: list of collected test items
+    :return: tuple of (reordered items, transitions before, transitions after)
+    '''
+    # split into contiguous blocks of items from the same class
+    blocks = []
+    for item in items:
+        cls = getattr(item, u'cls', None)
+        if blocks and cls is not None and blocks[-1][0] is cls:
+            blocks[-1][2].append(item)
+        else:
+            blocks.append((cls, _config_key(item), [item]))
+
+    groups = OrderedDict([(None, [])])
+    for cls, key, block_items in blocks:
+        groups.setdefault(key, []).append((key, block_items))
+
+    ordered = [block for group in groups.values() for block in group]
+    before = _transitions(key for _, key, _ in blocks)
+    after = _transitions(key for key, _ in ordered)
+    return [item for _, block_items in ordered for item in block_items], before, after
+
+
+def _select_affected(config, items):
+    '''
+    Deselects the items that aren't affected by the files changed since --ckantest-impact-since.
+    '''
+    from ckantest.impact import ImpactMap
+
+    root = str(config.rootdir)
+    path = config.option.ckantest_impact_map
+    if not os.path.exists(path):
+        config._ckantest_impact_note = u'no impact map at {0}; running everything'.format(path)
+        return
+    impact_map = ImpactMap.load(path)
+    changed, reason = impact_map.changes(root, config.option.ckantest_impact_since)
+    if reason is not None:
+        config._ckantest_impact_note = u'impact map is stale ({0}); running everything'.format(
+            reason)
+        return
+    selected = []
+    deselected = []
+    for item in items:
+        test_file = os.path.relpath(str(item.fspath), root)
+        if impact_map.affected(item.nodeid, test_file, changed):
+            selected.append(item)
+        else:
+            deselected.append(item)
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = selected
+    config._ckantest_impact_note = u'{0} changed files affect {1} of {2} tests'.format(
+        len(changed), len(selected), len(selected) + len(deselected))
+
+
+def pytest_collection_modifyitems(session, config, items):
+    if config.option.ckantest_impact_since:
+        _select_affected(config, items)
+    if not config.getoption(u'ckantest_schedule'):
+        return
+    items[:], before, after = schedule(items)
+    config._ckantest_schedule = (before, after)
+
+
+def pytest_report_collectionfinish(config, items):
+    lines = []
+    if hasattr(config, u'_ckantest_impact_note'):
+        lines.append(u'ckantest: ' + config._ckantest_impact_note)
+    if hasattr(config, u'_ckantest_schedule'):
+        before, after = config._ckantest_schedule
+        lines.append(u'ckantest: {0} plugin transitions after reordering (was {1}, saved '
+                     u'{2})'.format(after, before, before - after))
+    return lines
+
+
+# shared fixtures: set ckantest_plugins and ckantest_persist at module level to configure them
+# (the equivalents of TestBase.plugins and TestBase.persist). Modules with the same plugins
+# and persistent config share one configurer and app, as consecutive TestBase classes do. The
+# fixtures are prefixed so they can't clash with ckan's own (e.g. app and sysadmin).
+
+
+def pytest_sessionfinish(session, exitstatus):
+    from sys import modules
+
+    # only release the cache if something used it
+    testbase = modules.get(u'ckantest.models.testbase')
+    if testbase is not None:
+        testbase.AppCache.release()
+
+
+@pytest.fixture(scope=u'module')
+def _ckantest_state(request):
+    from ckantest.models.testbase import AppCache
+
+    plugins = getattr(request.module, u'ckantest_plugins', [])
+    persist = getattr(request.module, u'ckantest_persist', {})
+    config, app = AppCache.load(plugins, persist)
+    state = {
+        u'config': config,
+        u'app': app,
+        u'data_factory': None
+        }
+    yield state
+    if state[u'data_factory'] is not None:
+        state[u'data_factory'].destroy()
+    # the plugins stay loaded in case the next module can use them
+    AppCache.done(config)
+
+
+@pytest.fixture(scope=u'module')
+def ckantest_configurer(_ckantest_state):
+    '''
+    The module's Configurer, with ckantest_plugins loaded.
+    '''
+    return _ckantest_state[u'config']
+
+
+@pytest.fixture(scope=u'module')
+def ckantest_app(_ckantest_state):
+    '''
+    The test app for the module's plugins.
+    '''
+    return _ckantest_state[u'app']
+
+
+@pytest.fixture(scope=u'module')
+def ckantest_data_factory(_ckantest_state):
+    '''
+    A DataFactory shared by every test in the module, for tests that only read its data. It
+    uses snapshot mode, so the database is restored rather than rebuilt afterwards. Use
+    ckantest_isolated_data_factory for tests that change data.
+    '''
+    from ckantest.factories import DataFactory
+
+    if _ckantest_state[u'data_factory'] is None:
+        with _ckantest_state[u'app'].flask_app.test_request_context():
+            _ckantest_state[u'data_factory'] = DataFactory(snapshot=True)
+    return _ckantest_state[u'data_factory']
+
+
+@pytest.fixture(scope=u'module')
+def ckantest_sysadmin(ckantest_data_factory):
+    '''
+    The data factory's sysadmin user dict.
+    '''
+    return ckantest_data_factory.sysadmin
+
+
+@pytest.fixture
+def ckantest_isolated_config(ckantest_configurer):
+    '''
+    The module's Configurer; any config changes made during the test are reverted afterwards.
+    '''
+    with ckantest_configurer.override({}):
+        yield ckantest_configurer
+
+
+@pytest.fixture(scope=u'module')
+def _ckantest_module_snapshot(ckantest_data_factory):
+    # taken lazily on first use, after any module-scoped fixtures have created their data
+    from ckantest.helpers.database import Snapshot
+
+    snapshot = Snapshot()
+    snapshot.take(**ckantest_data_factory.dump_state())
+    return snapshot
+
+
+@pytest.fixture
+def ckantest_isolated_data_factory(ckantest_data_factory, _ckantest_module_snapshot,
+                                   ckantest_isolated_config):
+    '''
+    The module's DataFactory; the database tables, search index entries and in-memory
+    datastore tables the test changes, the factory's maps and the config are restored to their
+    state before the test afterwards, so the test can change data without affecting others.
+    '''
+    from ckantest.helpers import database
+    from ckantest.plugins.memory_datastore import store
+
+    with store.checkpoint(), database.WriteTracker() as tracker:
+        yield ckantest_data_factory
+    ckantest_data_factory.load_state(database.restore_tables(_ckantest_module_snapshot,
+                                                             tracker.tables))
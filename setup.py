@@ -30,5 +30,17 @@ setup(
     include_package_data=True,
     install_requires=[u'ckan',
                       u'mock',
-                      u'beaker']
+                      u'beaker'],
+    entry_points={
+        u'pytest11': [
+            u'ckantest = ckantest.pytest_plugin'
+            ],
+        u'ckan.plugins': [
+            u'memory_datastore = ckantest.plugins.memory_datastore:MemoryDatastorePlugin'
+            ],
+        u'console_scripts': [
+            u'ckantest-benchmark = ckantest.helpers.benchmark:main',
+            u'ckantest-importtime = ckantest.importtime:main'
+            ]
+        }
     )